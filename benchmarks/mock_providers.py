@@ -0,0 +1,217 @@
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# One local server stands in for every provider; each is mounted under its own path prefix:
+#   OpenAI      {url}/openai/v1/chat/completions
+#   Together    {url}/together/v1/chat/completions
+#   Anthropic   {url}/anthropic/v1/messages
+#   Gemini      {url}/gemini/v1beta/models/<model>:generateContent (REST transport)
+PROVIDER_PREFIXES = {"openai": "OpenAI", "together": "Meta-Llama", "anthropic": "Claude", "gemini": "Gemini"}
+
+DEFAULT_PROFILE = {
+    "latency_ms": 300,         # time before the response (or first chunk) is sent
+    "jitter_ms": 100,          # uniform +/- jitter on latency_ms
+    "chunk_delay_ms": 15,      # delay between streamed chunks
+    "output_tokens": 120,      # words in each response; one word per streamed chunk
+    "error_rate": 0.0,         # fraction of requests answered with error_status
+    "error_status": 503,
+    "retry_after": None,       # seconds, sent as retry-after on error responses
+}
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients closing pooled keep-alive connections is expected, not worth a traceback.
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class MockProviderServer:
+    def __init__(self, profiles=None, host="127.0.0.1", port=0):
+        # profiles maps api_choice ("OpenAI", "Claude", ...) or "default" to overrides of DEFAULT_PROFILE.
+        self.profiles = profiles or {}
+        self.requests = {name: 0 for name in PROVIDER_PREFIXES.values()}
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self.httpd = _Server((host, port), _make_handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self):
+        # Environment that points every provider client in src/utils at this server.
+        return {
+            "OPENAI_BASE_URL": f"{self.url}/openai/v1",
+            "TOGETHER_BASE_URL": f"{self.url}/together/v1",
+            "ANTHROPIC_BASE_URL": f"{self.url}/anthropic",
+            "GEMINI_API_ENDPOINT": f"{self.url}/gemini",
+            "OPENAI_API_KEY": "mock",
+            "ANTHROPIC_API_KEY": "mock",
+            "TOGETHER_API_KEY": "mock",
+            "GEMINI_API_KEY": "mock",
+        }
+
+    def profile(self, api_choice):
+        return {**DEFAULT_PROFILE, **self.profiles.get("default", {}), **self.profiles.get(api_choice, {})}
+
+    def record(self, api_choice, size):
+        with self._lock:
+            self.requests[api_choice] += 1
+            self.bytes_received += size
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-providers", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def _words(count):
+    return [f"word{i % 50}" for i in range(count)]
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            prefix, _, rest = self.path.lstrip("/").partition("/")
+            api_choice = PROVIDER_PREFIXES.get(prefix)
+            body = self.rfile.read(int(self.headers.get("content-length") or 0))
+            # Only generation is mocked; Gemini files and cached contents are reported as unavailable.
+            generation = any(method in rest for method in (":generateContent", ":streamGenerateContent"))
+            if api_choice is None or (api_choice == "Gemini" and not generation):
+                return self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            server.record(api_choice, len(body))
+            request = json.loads(body or b"{}")
+            profile = server.profile(api_choice)
+
+            latency = profile["latency_ms"] + random.uniform(-profile["jitter_ms"], profile["jitter_ms"])
+            time.sleep(max(0.0, latency) / 1000)
+            if random.random() < profile["error_rate"]:
+                headers = {"retry-after": str(profile["retry_after"])} if profile["retry_after"] is not None else {}
+                return self._send_json(profile["error_status"], {"error": {"message": "mock provider error", "type": "mock_error"}}, headers)
+
+            words = _words(profile["output_tokens"])
+            input_tokens = len(body) // 4
+            if api_choice == "Gemini":
+                stream = ":streamGenerateContent" in rest
+                return self._gemini(words, input_tokens, stream, profile)
+            stream = bool(request.get("stream"))
+            if api_choice == "Claude":
+                return self._anthropic(request, words, input_tokens, stream, profile)
+            return self._chat_completions(request, words, input_tokens, stream, profile)
+
+        def _chat_completions(self, request, words, input_tokens, stream, profile):
+            usage = {"prompt_tokens": input_tokens, "completion_tokens": len(words), "total_tokens": input_tokens + len(words)}
+            base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()), "model": request.get("model")}
+            if not stream:
+                return self._send_json(200, {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                    "usage": usage,
+                })
+            events = [
+                {**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+                for word in words
+            ]
+            events.append({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (request.get("stream_options") or {}).get("include_usage"):
+                events.append({**base, "object": "chat.completion.chunk", "choices": [], "usage": usage})
+            self._send_sse([(None, event) for event in events] + [(None, "[DONE]")], profile)
+
+        def _anthropic(self, request, words, input_tokens, stream, profile):
+            message = {
+                "id": f"msg_{uuid.uuid4().hex}",
+                "type": "message",
+                "role": "assistant",
+                "model": request.get("model"),
+                "content": [],
+                "stop_reason": None,
+                "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+            }
+            if not stream:
+                message.update(content=[{"type": "text", "text": " ".join(words)}], stop_reason="end_turn")
+                message["usage"]["output_tokens"] = len(words)
+                return self._send_json(200, message)
+            events = [("message_start", {"type": "message_start", "message": message}),
+                      ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})]
+            events += [("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": word + " "}}) for word in words]
+            events += [("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                       ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": len(words)}}),
+                       ("message_stop", {"type": "message_stop"})]
+            self._send_sse(events, profile)
+
+        def _gemini(self, words, input_tokens, stream, profile):
+            def response(text, output_tokens):
+                return {
+                    "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": 1, "index": 0}],
+                    "usageMetadata": {"promptTokenCount": input_tokens, "candidatesTokenCount": output_tokens, "totalTokenCount": input_tokens + output_tokens},
+                }
+            if not stream:
+                return self._send_json(200, response(" ".join(words), len(words)))
+            # The REST transport streams a single JSON array of responses.
+            self._start_chunked(200, "application/json")
+            self._write_chunk("[")
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(profile["chunk_delay_ms"] / 1000)
+                self._write_chunk(("," if i else "") + json.dumps(response(word + " ", i + 1)))
+            self._write_chunk("]")
+            self._write_chunk("")
+
+        def _send_json(self, status, payload, headers=None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("content-type", "application/json")
+            self.send_header("content-length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_sse(self, events, profile):
+            self._start_chunked(200, "text/event-stream")
+            for i, (event, data) in enumerate(events):
+                if i:
+                    time.sleep(profile["chunk_delay_ms"] / 1000)
+                payload = data if isinstance(data, str) else json.dumps(data)
+                self._write_chunk((f"event: {event}\n" if event else "") + f"data: {payload}\n\n")
+            self._write_chunk("")
+
+        def _start_chunked(self, status, content_type):
+            self.send_response(status)
+            self.send_header("content-type", content_type)
+            self.send_header("transfer-encoding", "chunked")
+            self.end_headers()
+
+        def _write_chunk(self, text):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+import numpy as np
+from PIL import Image
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARK_DIR))
+sys.path.insert(0, str(BENCHMARK_DIR.parent / "src"))
+
+from mock_providers import DEFAULT_PROFILE, MockProviderServer
+
+MODELS = {
+    "Gemini": "gemini-1.5-flash",
+    "OpenAI": "gpt-4o-mini",
+    "Claude": "claude-3-5-sonnet-20240620",
+    "Meta-Llama": "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
+}
+IMAGE_SIZES = {"small": (512, 512), "medium": (1536, 1536), "large": (4032, 3024)}
+TEXT_SIZES = {"small": 2_000, "medium": 20_000, "large": 100_000}
+PROMPT = "Describe this in detail, highlighting what would make it engaging on social media."
+MAX_TOKENS = 512
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark process_image/process_text against local mock provider servers.")
+    parser.add_argument("--providers", default="Gemini,OpenAI,Claude,Meta-Llama")
+    parser.add_argument("--kinds", default="image,text")
+    parser.add_argument("--sizes", default="small,medium,large")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--modes", default="call,stream", help="call (process_*) and/or stream (stream_*)")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per scenario")
+    parser.add_argument("--profile", help="JSON file of server profiles keyed by provider or 'default'")
+    for name, value in DEFAULT_PROFILE.items():
+        if name != "retry_after":
+            parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), help=f"Server {name} (default {value})")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Skip peak memory tracing, which adds overhead")
+    parser.add_argument("-o", "--output", help="Results file (default benchmarks/results/<timestamp>.json)")
+    return parser.parse_args()
+
+
+def server_profiles(args):
+    profiles = json.loads(Path(args.profile).read_text()) if args.profile else {}
+    overrides = {name: getattr(args, name) for name in DEFAULT_PROFILE if getattr(args, name, None) is not None}
+    profiles["default"] = {**profiles.get("default", {}), **overrides}
+    return profiles
+
+
+def configure_environment(server):
+    """Point the app at the mock server and at throwaway caches; returns the scratch directory to remove afterwards."""
+    # Must run before anything from src/utils is imported: several modules read these at import time.
+    os.environ.update(server.env())
+    # Benchmark images must neither land in the developer's result cache and image index nor be answered from them.
+    scratch = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ["RESULT_CACHE_PATH"] = os.path.join(scratch, "results.sqlite3")
+    os.environ["IMAGE_INDEX_PATH"] = os.path.join(scratch, "image_index.sqlite3")
+    os.environ["IMAGE_REUSE_MODE"] = "off"
+    os.environ["CASSETTE_MODE"] = "off"
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("LOG_FILE", str(BENCHMARK_DIR / "results" / "benchmark.log"))
+    # The Files API cannot be pointed at a local server, so keep every Gemini image inline.
+    os.environ["GEMINI_INLINE_MAX_BYTES"] = str(256 * 1024 * 1024)
+    for provider in MODELS:
+        prefix = f"RATE_LIMIT_{provider.upper().replace('-', '_')}"
+        os.environ.setdefault(f"{prefix}_RPM", "1000000")
+        os.environ.setdefault(f"{prefix}_TPM", "1000000000")
+    return scratch
+
+
+def make_image(size):
+    width, height = IMAGE_SIZES[size]
+    # A gradient with noise compresses roughly like a photo, unlike a flat colour.
+    rng = np.random.default_rng(0)
+    gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    pixels = np.clip(gradient + rng.normal(0, 40, (height, width, 3)), 0, 255).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def make_text(size):
+    words = ("brand", "launch", "summer", "collection", "audience", "engagement", "story", "visual")
+    text = " ".join(words[i % len(words)] for i in range(TEXT_SIZES[size] // 7))
+    return text[:TEXT_SIZES[size]]
+
+
+def run_request(kind, provider, payload, mode):
+    from utils.image_processing import process_image, stream_image
+    from utils.text_processing import process_text, stream_text
+    from utils.scheduler import StreamInterrupted
+
+    model = MODELS[provider]
+    started = time.perf_counter()
+    first_chunk = None
+    if kind == "image":
+        image_file = BytesIO(payload)
+        image_file.name = "benchmark.jpg"
+        if mode == "stream":
+            parts = []
+            try:
+                for chunk in stream_image(image_file, PROMPT, provider, model, 1.0, 0.95, MAX_TOKENS, use_cache=False):
+                    first_chunk = first_chunk or time.perf_counter()
+                    parts.append(chunk)
+                result = "".join(parts)
+            except StreamInterrupted:
+                # A truncated stream counts as a failed request.
+                result = None
+        else:
+            result = process_image(image_file, PROMPT, provider, model, 1.0, 0.95, MAX_TOKENS, use_cache=False)
+    else:
+        if mode == "stream":
+            parts = []
+            try:
+                for chunk in stream_text(payload, PROMPT, provider, model, 1.0, 0.95, MAX_TOKENS, use_cache=False):
+                    first_chunk = first_chunk or time.perf_counter()
+                    parts.append(chunk)
+                result = "".join(parts)
+            except StreamInterrupted:
+                # A truncated stream counts as a failed request.
+                result = None
+        else:
+            result = process_text(payload, PROMPT, provider, model, 1.0, 0.95, MAX_TOKENS, use_cache=False)
+    finished = time.perf_counter()
+    return {
+        "ok": bool(result),
+        "latency": finished - started,
+        "first_chunk": first_chunk - started if first_chunk else None,
+    }
+
+
+def percentiles(values):
+    if not values:
+        return None
+    ms = np.array(values) * 1000
+    return {
+        "p50": round(float(np.percentile(ms, 50)), 2),
+        "p95": round(float(np.percentile(ms, 95)), 2),
+        "p99": round(float(np.percentile(ms, 99)), 2),
+        "mean": round(float(ms.mean()), 2),
+        "max": round(float(ms.max()), 2),
+    }
+
+
+def run_scenario(server, kind, provider, size, payload, mode, concurrency, requests, trace_memory):
+    received_before = server.bytes_received
+    if trace_memory:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        samples = list(executor.map(lambda _: run_request(kind, provider, payload, mode), range(requests)))
+    wall = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] - baseline if trace_memory else None
+
+    ok = [sample for sample in samples if sample["ok"]]
+    return {
+        "kind": kind,
+        "provider": provider,
+        "model": MODELS[provider],
+        "size": size,
+        "payload_bytes": len(payload if isinstance(payload, bytes) else payload.encode("utf-8")),
+        "mode": mode,
+        "concurrency": concurrency,
+        "requests": requests,
+        "ok": len(ok),
+        "errors": requests - len(ok),
+        "latency_ms": percentiles([sample["latency"] for sample in ok]),
+        "first_chunk_ms": percentiles([sample["first_chunk"] for sample in ok if sample["first_chunk"] is not None]),
+        "throughput_rps": round(len(ok) / wall, 2),
+        "wall_seconds": round(wall, 3),
+        "peak_memory_mb": round(peak / 1024 / 1024, 2) if peak is not None else None,
+        "bytes_sent": server.bytes_received - received_before,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result):
+    latency = result["latency_ms"] or {}
+    memory = f"{result['peak_memory_mb']:8.2f} MB" if result["peak_memory_mb"] is not None else ""
+    print(
+        f"{result['kind']:5} {result['provider']:10} {result['size']:6} {result['mode']:6} c={result['concurrency']:<3} "
+        f"ok={result['ok']:<3} p50={latency.get('p50', 0):8.1f} p95={latency.get('p95', 0):8.1f} "
+        f"p99={latency.get('p99', 0):8.1f} ms  {result['throughput_rps']:7.2f} req/s {memory}"
+    )
+
+
+def main():
+    args = parse_args()
+    profiles = server_profiles(args)
+    server = MockProviderServer(profiles).start()
+    scratch = configure_environment(server)
+    (BENCHMARK_DIR / "results").mkdir(exist_ok=True)
+
+    providers = args.providers.split(",")
+    kinds = args.kinds.split(",")
+    sizes = args.sizes.split(",")
+    modes = args.modes.split(",")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    payloads = {("image", size): make_image(size) for size in sizes if "image" in kinds}
+    payloads.update({("text", size): make_text(size) for size in sizes if "text" in kinds})
+
+    # Warm up once per provider so SDK imports and connection setup are not counted.
+    for provider in providers:
+        run_request("text", provider, "warm up", "call")
+
+    trace_memory = not args.no_tracemalloc
+    if trace_memory:
+        tracemalloc.start()
+    results = []
+    try:
+        for kind in kinds:
+            for provider in providers:
+                if kind == "image" and provider == "Meta-Llama":
+                    # Meta-Llama has no vision model; process_image routes it to Gemini.
+                    continue
+                for size in sizes:
+                    for mode in modes:
+                        for concurrency in levels:
+                            result = run_scenario(
+                                server, kind, provider, size, payloads[(kind, size)], mode, concurrency, args.requests, trace_memory
+                            )
+                            print_result(result)
+                            results.append(result)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        server.stop()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    output = Path(args.output) if args.output else BENCHMARK_DIR / "results" / f"{timestamp}.json"
+    report = {
+        "meta": {
+            "timestamp": timestamp,
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "server_profiles": {provider: server.profile(provider) for provider in providers},
+            "requests_per_scenario": args.requests,
+            "tracemalloc": trace_memory,
+            "server_requests": dict(server.requests),
+        },
+        "results": results,
+    }
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Wrote {len(results)} scenarios to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from pathlib import Path
+from dotenv import load_dotenv
+
+# Before importing utils: its modules read their settings at import time.
+load_dotenv()
+
+from utils.logger import setup_logger
+from utils.hedging import PROVIDER_API_KEYS
+from utils.image_processing import MAX_CONCURRENT_ANALYSES, process_image
+from utils.text_processing import process_text
+from utils.prompts import FINAL_CONTENT_PROMPT, build_final_content_input
+
+logger = setup_logger(__name__)
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif"}
+DEFAULT_PROMPT = "Describe this image in detail, highlighting the elements that would make it engaging on social media."
+PROGRESS_INTERVAL_SECONDS = 30
+# Used when --model is not given; the first model each provider offers on the content page.
+DEFAULT_MODELS = {
+    "Gemini": "gemini-1.5-flash",
+    "OpenAI": "gpt-4o",
+    "Claude": "claude-3-5-sonnet-20240620",
+    "Meta-Llama": "meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo",
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Analyze a batch of images and generate finished social media posts.")
+    parser.add_argument("input", help="Directory of images, or a .jsonl/.json/.csv manifest")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--api", default="Gemini", choices=("Gemini", "OpenAI", "Claude", "Meta-Llama"))
+    parser.add_argument("--model", help="Model for the chosen --api (default: that provider's first model on the content page)")
+    parser.add_argument("--vision-model", default="gemini-1.5-flash", help="Gemini model used for image analysis when --api is Meta-Llama")
+    parser.add_argument("--prompt", default=DEFAULT_PROMPT, help="Analysis prompt for items that do not set their own")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-p", type=float, default=0.94)
+    parser.add_argument("--max-tokens", type=int, default=1024)
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENT_ANALYSES)
+    parser.add_argument("--analysis-only", action="store_true", help="Skip final content generation")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the result cache")
+    args = parser.parse_args()
+    if args.model is None:
+        args.model = DEFAULT_MODELS[args.api]
+    return args
+
+
+def load_items(input_path, default_prompt):
+    path = Path(input_path)
+    if path.is_dir():
+        items = []
+        for image_path in sorted(p for p in path.rglob("*") if p.suffix.lower() in IMAGE_EXTENSIONS):
+            item = {"id": str(image_path.relative_to(path)), "image": str(image_path)}
+            # Optional sidecar metadata: IMG_0001.jpg -> IMG_0001.json
+            sidecar = image_path.with_suffix(".json")
+            if sidecar.exists():
+                item.update({k: v for k, v in json.loads(sidecar.read_text()).items() if k != "image"})
+            items.append(item)
+    elif path.suffix == ".jsonl":
+        with open(path) as f:
+            items = [json.loads(line) for line in f if line.strip()]
+    elif path.suffix == ".json":
+        items = json.loads(path.read_text())
+    elif path.suffix == ".csv":
+        with open(path, newline="") as f:
+            items = list(csv.DictReader(f))
+    else:
+        raise ValueError(f"Unsupported input: {input_path}")
+
+    for item in items:
+        image = Path(item["image"])
+        if not image.is_absolute() and not path.is_dir():
+            image = path.parent / image
+        item["image"] = str(image)
+        item.setdefault("id", item["image"])
+        item["prompt"] = item.get("prompt") or default_prompt
+        item.setdefault("caption", "")
+        item.setdefault("hashtags", "")
+    return items
+
+
+def load_completed(output_path):
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a truncated last line.
+                continue
+            if record.get("status") == "ok":
+                completed.add(record["id"])
+    return completed
+
+
+def process_item(item, args):
+    started = time.perf_counter()
+    record = {"id": item["id"], "image": item["image"]}
+    with open(item["image"], "rb") as f:
+        image_file = BytesIO(f.read())
+    image_file.name = os.path.basename(item["image"])
+
+    vision_api, vision_model = args.api, args.model
+    if vision_api == "Meta-Llama":
+        vision_api, vision_model = "Gemini", args.vision_model
+    use_cache = not args.no_cache
+
+    analysis = process_image(
+        image_file, item["prompt"], vision_api, vision_model, args.temperature, args.top_p, args.max_tokens, use_cache
+    )
+    record["analysis"] = analysis
+    if not analysis:
+        record["status"] = "failed"
+        record["error"] = "image analysis returned no result"
+    elif args.analysis_only:
+        record["status"] = "ok"
+    else:
+        content = build_final_content_input(analysis, item["caption"], item["hashtags"])
+        final_content = process_text(
+            content, FINAL_CONTENT_PROMPT, args.api, args.model, args.temperature, args.top_p, args.max_tokens, use_cache
+        )
+        record["final_content"] = final_content
+        record["status"] = "ok" if final_content else "failed"
+        if not final_content:
+            record["error"] = "final content generation returned no result"
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def run(args):
+    required = {PROVIDER_API_KEYS[args.api]}
+    if args.api == "Meta-Llama":
+        # Meta-Llama has no vision model, so images are analyzed by Gemini.
+        required.add(PROVIDER_API_KEYS["Gemini"])
+        if args.analysis_only:
+            required.discard(PROVIDER_API_KEYS["Meta-Llama"])
+    missing = sorted(name for name in required if os.getenv(name) is None)
+    if missing:
+        raise SystemExit(f"{', '.join(missing)} environment variable{'s are' if len(missing) > 1 else ' is'} not set")
+
+    items = load_items(args.input, args.prompt)
+    completed = load_completed(args.output)
+    pending = [item for item in items if item["id"] not in completed]
+    logger.info(f"Batch of {len(items)} items: {len(items) - len(pending)} already done, {len(pending)} to process")
+    if not pending:
+        return
+
+    started = time.perf_counter()
+    last_report = started
+    done = failed = 0
+    with open(args.output, "a") as output, ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {executor.submit(process_item, item, args): item for item in pending}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                logger.error(f"Batch item {item['id']} failed: {str(e)}")
+                record = {"id": item["id"], "image": item["image"], "status": "failed", "error": str(e)}
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            done += 1
+            failed += record["status"] != "ok"
+
+            now = time.perf_counter()
+            if now - last_report >= PROGRESS_INTERVAL_SECONDS:
+                last_report = now
+                logger.info(f"Progress: {done}/{len(pending)} items, {done / (now - started) * 60:.1f} images/min")
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        f"Batch finished: {done - failed} succeeded, {failed} failed in {elapsed:.1f}s "
+        f"({done / elapsed * 60:.1f} images/min). Results in {args.output}"
+    )
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from utils.sdk import SDK_REGISTRY
+
+# What a page pays for at startup, followed by what each provider adds on first use.
+DEFAULT_TARGETS = ["utils.image_processing", "utils.text_processing"] + [module for module, _ in SDK_REGISTRY.values()]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Report module import costs, built on python -X importtime.")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_TARGETS, help="Modules to import, each in a fresh interpreter")
+    parser.add_argument("--top", type=int, default=10, help="Number of heaviest top-level packages to list per module")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    return parser.parse_args()
+
+
+def measure(module):
+    # A fresh interpreter per module, so nothing is already in sys.modules.
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    entries = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        entries.append((name.strip(), int(self_us), int(cumulative_us)))
+    if completed.returncode != 0:
+        return {"module": module, "error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "import failed"}
+
+    by_package = defaultdict(int)
+    for name, self_us, _ in entries:
+        by_package[name.split(".")[0]] += self_us
+    total_us = next((cumulative for name, _, cumulative in entries if name == module), sum(by_package.values()))
+    return {
+        "module": module,
+        "total_ms": round(total_us / 1000, 1),
+        "modules_imported": len(entries),
+        "packages": {package: round(us / 1000, 1) for package, us in sorted(by_package.items(), key=lambda item: -item[1])},
+    }
+
+
+def print_report(results, top):
+    for result in results:
+        if "error" in result:
+            print(f"{result['module']}: {result['error']}")
+            continue
+        print(f"{result['module']}: {result['total_ms']:.1f} ms, {result['modules_imported']} modules")
+        for package, ms in list(result["packages"].items())[:top]:
+            print(f"    {ms:9.1f} ms  {package}")
+
+
+def main():
+    args = parse_args()
+    results = [measure(module) for module in args.modules]
+    if args.json:
+        for result in results:
+            result["packages"] = dict(list(result.get("packages", {}).items())[:args.top])
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results, args.top)
+
+
+if __name__ == '__main__':
+    main()
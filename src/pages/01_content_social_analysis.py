@@ -1,16 +1,33 @@
 import streamlit as st
 from dotenv import load_dotenv
 import os
-import google.generativeai as genai
+import uuid
+
+# Load environment variables before importing utils: its modules read their settings at import time.
+load_dotenv()
+
 from utils.logger import setup_logger
-from utils.image_processing import process_image
-from utils.text_processing import process_text
+from utils.image_processing import (
+    process_image_with_fallback, process_images_batched, stream_image
+)
+from utils.text_processing import process_text_with_fallback, stream_text
+from utils.prompts import FINAL_CONTENT_PROMPT, build_final_content_input
+from utils import image_index, jobs, result_cache
+from utils.thumbnails import thumbnail
 
 # Set up logging
-logger = setup_logger()
+logger = setup_logger(__name__)
 
-# Load environment variables
-load_dotenv()
+FALLBACK_MODES = {"Off": None, "Failover": "failover", "Hedge": "hedge"}
+GALLERY_PAGE_SIZE = int(os.getenv("GALLERY_PAGE_SIZE", "6"))
+GALLERY_COLUMNS = 3
+# Widget values of images on other gallery pages, kept although their widgets are not rendered.
+PER_IMAGE_WIDGET_PREFIXES = ("prompt_", "caption_", "hashtags_")
+# How often the page checks on queued and running jobs while any are pending.
+JOBS_POLL_SECONDS = float(os.getenv("JOBS_POLL_SECONDS", "1"))
+# How often a job's text is refreshed once it has started streaming.
+JOBS_STREAM_POLL_SECONDS = float(os.getenv("JOBS_STREAM_POLL_SECONDS", "0.2"))
+BATCH_JOB = "analysis_batch"
 
 def display_instructions():
     with st.expander("📋 How to Use This Tool", expanded=True):
@@ -20,8 +37,11 @@ def display_instructions():
            - Adjust parameters like temperature, top-p, and max tokens to fine-tune the output.
         
         2. Upload Your Images:
-           - Upload up to 3 images you want to analyze and create content for.
+           - Upload the images you want to analyze and create content for; they are shown a page at a time.
            - Enter a prompt for each image to guide the AI in generating insights.
+           - Use 'Analyze All Images' to analyze every image with a prompt at the same time.
+           - Or give one shared prompt and use 'Analyze Together' to send all images in a single request.
+           - Analyses run in the background, so you can keep working on other images while they finish.
         
         3. Review the Image Analysis:
            - Review the AI-generated analysis to understand key insights about the image content.
@@ -73,17 +93,17 @@ def get_api_info():
         temp = st.sidebar.slider("Temperature:", min_value=0.0, max_value=2.0, value=1.0, step=0.25)
         topp = st.sidebar.slider("Top P:", min_value=0.0, max_value=1.0, value=0.94, step=0.01)
         max_tokens = st.sidebar.slider("Maximum Tokens:", min_value=100, max_value=8194, value=200, step=50)
-        logger.info(f"API choice: Gemini, Model: {model}, Temperature: {temp}, Top P: {topp}, Max Tokens: {max_tokens}")
+        logger.debug(f"API choice: Gemini, Model: {model}, Temperature: {temp}, Top P: {topp}, Max Tokens: {max_tokens}")
         return api_choice, model, temp, topp, max_tokens
     elif api_choice == "OpenAI":
         openai_model = st.sidebar.radio("Choose OpenAI Model:", ("gpt-4o", "gpt-4o-mini", "gpt-4-turbo"))
         max_tokens = st.sidebar.slider("Maximum Tokens:", min_value=100, max_value=8000, value=300, step=50)
-        logger.info(f"API choice: OpenAI, Model: {openai_model}, Max Tokens: {max_tokens}")
+        logger.debug(f"API choice: OpenAI, Model: {openai_model}, Max Tokens: {max_tokens}")
         return api_choice, openai_model, None, None, max_tokens
     elif api_choice == "Claude":
         claude_model = st.sidebar.radio("Choose Claude Model:", ("claude-3-5-sonnet-20240620", "claude-3-opus-20240229"))
         max_tokens = st.sidebar.slider("Maximum Tokens:", min_value=100, max_value=4096, value=1024, step=100)
-        logger.info(f"API choice: Claude, Model: {claude_model}, Max Tokens: {max_tokens}")
+        logger.debug(f"API choice: Claude, Model: {claude_model}, Max Tokens: {max_tokens}")
         return api_choice, claude_model, None, None, max_tokens
     elif api_choice == "Meta-Llama":
         model = st.sidebar.radio("Choose Meta-Llama Model:", (
@@ -94,56 +114,239 @@ def get_api_info():
         temp = st.sidebar.slider("Temperature:", min_value=0.0, max_value=2.0, value=1.0, step=0.25)
         topp = st.sidebar.slider("Top P:", min_value=0.0, max_value=1.0, value=0.94, step=0.01)
         max_tokens = st.sidebar.slider("Maximum Tokens:", min_value=100, max_value=8194, value=200, step=50)
-        logger.info(f"API choice: Meta-Llama, Model: {model}, Temperature: {temp}, Top P: {topp}, Max Tokens: {max_tokens}")
+        logger.debug(f"API choice: Meta-Llama, Model: {model}, Temperature: {temp}, Top P: {topp}, Max Tokens: {max_tokens}")
         return api_choice, model, temp, topp, max_tokens
 
 
+def show_resilience_options():
+    st.sidebar.radio(
+        "Resilience:",
+        tuple(FALLBACK_MODES),
+        key="resilience_mode",
+        help="Failover retries on another provider when the first fails. Hedge also sends the request to a "
+             "second provider when the first is slower than its usual p95 latency, and keeps the first good answer.",
+    )
+
+
+def fallback_mode():
+    return FALLBACK_MODES[st.session_state.get("resilience_mode", "Off")]
+
+
+def use_result_cache():
+    return not st.session_state.get("bypass_result_cache", False)
+
+
+def show_cache_stats():
+    st.sidebar.header("Result Cache", divider='rainbow')
+    st.sidebar.checkbox("Bypass result cache", key="bypass_result_cache")
+    if st.sidebar.button("Clear result cache", help="Deletes every cached analysis and final content on this server."):
+        if not result_cache.clear():
+            st.sidebar.error("Could not clear the result cache.")
+    stats = result_cache.stats()
+    st.sidebar.caption(
+        f"Hits: {stats['hits']} · Misses: {stats['misses']} · "
+        f"Entries: {stats['entries']} ({stats['bytes'] / 1024:.1f} KB)"
+    )
+
+
+def job_session():
+    # Jobs outlive reruns, so they are keyed by an id that lives as long as the browser session.
+    if "job_session" not in st.session_state:
+        st.session_state["job_session"] = uuid.uuid4().hex
+    return st.session_state["job_session"]
+
+
+def collect_finished_jobs():
+    for job in jobs.session_jobs(job_session()):
+        if job.state == jobs.FAILED:
+            # The error is shown once, where the job's result would have gone; resubmitting starts clean.
+            st.session_state.setdefault("failed_jobs", set()).add(job.name)
+            jobs.discard(job_session(), job.name)
+            continue
+        if job.state != jobs.DONE:
+            continue
+        if job.name == BATCH_JOB:
+            failed = []
+            for section_id, analysis in job.result.items():
+                if analysis:
+                    st.session_state[f"analysis_{section_id}"] = analysis
+                else:
+                    failed.append(str(section_id))
+            if failed:
+                st.error(f"Failed to analyze image(s) {', '.join(failed)}. Please try again.")
+        else:
+            # Per-image jobs are named after the session state key their result goes to.
+            st.session_state[job.name] = job.result
+        logger.info(f"Collected the result of {job.label}")
+        jobs.discard(job_session(), job.name)
+
+
+@st.fragment(run_every=JOBS_POLL_SECONDS)
+def show_job_progress(name):
+    job = jobs.get(job_session(), name)
+    if job is not None and not job.finished and job.partial:
+        # Output has started streaming; a full rerun switches to the faster-refreshing view.
+        st.rerun()
+    render_job_progress(job)
+
+
+@st.fragment(run_every=JOBS_STREAM_POLL_SECONDS)
+def show_job_stream(name):
+    render_job_progress(jobs.get(job_session(), name))
+
+
+def render_job_progress(job):
+    if job is None or job.finished:
+        # A full rerun collects the result and renders it in place.
+        st.rerun()
+    partial = job.partial
+    if job.state == jobs.QUEUED:
+        st.caption(f"⏳ {job.label}: queued")
+    elif partial:
+        st.caption(f"✍️ {job.label}: writing...")
+        st.write(partial)
+    else:
+        st.progress(job.progress, text=f"🔄 {job.label}: running")
+
+
+def show_job_status(name, failure_message):
+    failed_jobs = st.session_state.setdefault("failed_jobs", set())
+    job = jobs.get(job_session(), name)
+    if job is not None:
+        failed_jobs.discard(name)
+        # Also covers a job that finished since collect_finished_jobs ran: the fragment reruns the page.
+        if job.partial:
+            show_job_stream(name)
+        else:
+            show_job_progress(name)
+    elif name in failed_jobs:
+        failed_jobs.discard(name)
+        st.error(failure_message)
+
+
+@st.fragment(run_every=JOBS_POLL_SECONDS)
+def show_active_jobs(active):
+    # Reruns the page when a job finishes, including jobs of images on other gallery pages.
+    pending = [job for job in jobs.session_jobs(job_session()) if not job.finished]
+    if len(pending) < active:
+        st.rerun()
+    running = sum(job.state == jobs.RUNNING for job in pending)
+    st.info(f"⏳ {running} job(s) running, {len(pending) - running} queued. You can keep working meanwhile.")
+
+
 def generate_final_content(section_id, api_choice, model, temperature, top_p, max_tokens):
     analysis_result_key = f"analysis_{section_id}"
     caption = st.session_state[f"caption_{section_id}"]
     hashtags = st.session_state[f"hashtags_{section_id}"]
     
-    content = f"""
-    Original image analysis: {st.session_state[analysis_result_key]}
-    
-    User's caption: {caption}
-    
-    User's hashtags: {hashtags}
-    """
-    
-    prompt = """
-    Based on the provided information, generate a final, cohesive social media post that incorporates:
-    1. Key insights from the image analysis
-    2. The user's caption
-    3. The provided hashtags
-    
-    The post should be:
-    - Engaging and relevant to the image content
-    - Optimized for social media engagement
-    - Formatted appropriately for the platform (assume it's for Instagram)
-    - No longer than 2200 characters (Instagram's caption limit)
-    
-    Structure the response as follows:
-    1. Final Caption (including emojis if appropriate)
-    2. Hashtags (list the most relevant hashtags, max 30)
-    3. Brief explanation of how the final content incorporates the original analysis and user input
-    """
-    
-    with st.spinner("Generating final content..."):
-        final_result = process_text(content, prompt, api_choice, model, temperature, top_p, max_tokens)
-        if final_result:
-            st.subheader(f"Final Content for Image {section_id}")
-            st.write(final_result)
-            logger.info(f"Generated and displayed final content for Image {section_id}")
-        else:
-            st.error(f"Failed to generate final content for Image {section_id}")
-            logger.error(f"Failed to generate final content for Image {section_id}")
+    content = build_final_content_input(st.session_state[analysis_result_key], caption, hashtags)
+    # Widget state is read here; the job itself runs outside the script thread.
+    mode, use_cache = fallback_mode(), use_result_cache()
+
+    def run(job):
+        if mode:
+            return process_text_with_fallback(
+                content, FINAL_CONTENT_PROMPT, api_choice, model, temperature, top_p, max_tokens,
+                use_cache=use_cache, mode=mode
+            )
+        for chunk in stream_text(content, FINAL_CONTENT_PROMPT, api_choice, model, temperature, top_p, max_tokens, use_cache=use_cache):
+            job.append(chunk)
+        return job.partial
+
+    jobs.submit(job_session(), f"final_content_{section_id}", run, label=f"Final content for Image {section_id}")
+    logger.info(f"Queued final content generation for Image {section_id}")
+
+
+def resolve_vision_api(api_choice, model):
+    if api_choice == "Meta-Llama":
+        # Default to Gemini for image processing if Meta-Llama is selected
+        logger.info(f"Meta-Llama selected. Defaulting to Gemini for image analysis.")
+        return "Gemini", "gemini-1.5-flash"  # or another default model
+    return api_choice, model
+
+
+def submit_image_analysis(section_id, image_file, prompt, api_choice, model, temperature, top_p, max_tokens):
+    api_choice, model = resolve_vision_api(api_choice, model)
+    mode, use_cache = fallback_mode(), use_result_cache()
+
+    def run(job):
+        if mode:
+            return process_image_with_fallback(
+                image_file, prompt, api_choice, model, temperature, top_p, max_tokens,
+                use_cache=use_cache, mode=mode
+            )
+        for chunk in stream_image(image_file, prompt, api_choice, model, temperature, top_p, max_tokens, use_cache=use_cache):
+            job.append(chunk)
+        return job.partial
+
+    jobs.submit(job_session(), f"analysis_{section_id}", run, label=f"Analysis of Image {section_id}")
+    logger.info(f"Queued analysis for image {section_id}. API: {api_choice}, Model: {model}")
+
+
+def analyze_all_images(uploaded_files, api_choice, model, temperature, top_p, max_tokens):
+    queued = 0
+    for i, file in enumerate(uploaded_files):
+        section_id = i + 1
+        prompt = st.session_state.get(f"prompt_{section_id}")
+        if prompt:
+            submit_image_analysis(section_id, file, prompt, api_choice, model, temperature, top_p, max_tokens)
+            queued += 1
+    if not queued:
+        st.warning("Enter a prompt for at least one image before analyzing all.")
+        return
+    # Images on other gallery pages have no status widget of their own; rerunning shows the jobs
+    # in the page-wide status, which polls until they finish.
+    st.rerun()
+
+
+def analyze_images_together(uploaded_files, prompt, api_choice, model, temperature, top_p, max_tokens):
+    if not prompt:
+        st.warning("Enter a shared prompt before analyzing the images together.")
+        return
+
+    api_choice, model = resolve_vision_api(api_choice, model)
+    use_cache = use_result_cache()
+    images = [(i + 1, file) for i, file in enumerate(uploaded_files)]
+
+    def run(job):
+        results = {}
+        for done, (section_id, analysis) in enumerate(
+            process_images_batched(images, prompt, api_choice, model, temperature, top_p, max_tokens, use_cache),
+            start=1
+        ):
+            results[section_id] = analysis
+            if not analysis:
+                logger.warning(f"Analysis for image {section_id} returned no results")
+            job.report(progress=done / len(images))
+        return results
+
+    jobs.submit(job_session(), BATCH_JOB, run, label=f"Analysis of {len(images)} images together")
+    logger.info(f"Queued a multi-image analysis of {len(images)} images with API: {api_choice}, Model: {model}")
+    st.rerun()
+
+
+def offer_near_duplicate(section_id, image_file, prompt, api_choice, model):
+    if image_index.IMAGE_REUSE_MODE != "offer" or not use_result_cache():
+        return
+    api_choice, model = resolve_vision_api(api_choice, model)
+    match = image_index.find_similar(image_file.getvalue(), prompt, api_choice, model)
+    if match is None:
+        return
+    st.info(
+        f"♻️ A near-duplicate of this image ({match['name']}, {match['distance']} bits apart) "
+        f"was already analyzed with this prompt and model."
+    )
+    if st.button(f"Reuse Earlier Analysis for Image {section_id}"):
+        st.session_state[f"analysis_{section_id}"] = match["analysis"]
+        logger.info(f"Reused the analysis of near-duplicate {match['name']} for image {section_id}")
 
 
 def analyze_image(section_id, image_file, api_choice, model, temperature, top_p, max_tokens):
     if image_file is not None:
-        logger.info(f"Starting analysis for Image {section_id}")
-        st.image(image_file, caption=f"Image {section_id}", use_column_width=True)
+        # Only a cached thumbnail is sent to the browser; the full image is loaded on request.
+        st.image(thumbnail(image_file.getvalue()), caption=f"Image {section_id}", use_column_width=True)
+        if st.toggle("Show full size", key=f"full_size_{section_id}"):
+            st.image(image_file, use_column_width=True)
         
         prompt = st.text_area(f"Enter a prompt for Image {section_id}", key=f"prompt_{section_id}", height=100)
         
@@ -151,22 +354,12 @@ def analyze_image(section_id, image_file, api_choice, model, temperature, top_p,
         analysis_result_key = f"analysis_{section_id}"
 
         if analyze_button and prompt:
-            with st.spinner("Analyzing image..."):
-                if api_choice == "Meta-Llama":
-                    # Default to Gemini for image processing if Meta-Llama is selected
-                    logger.info(f"Meta-Llama selected. Defaulting to Gemini for image analysis.")
-                    model = "gemini-1.5-flash"  # or another default model
-                    api_choice = "Gemini"
-                
-                logger.info(f"Starting analysis for image {section_id}. API: {api_choice}, Model: {model}")
-                analysis = process_image(image_file, prompt, api_choice, model, temperature, top_p, max_tokens)
-                
-                if analysis:
-                    logger.info(f"Successfully analyzed image {section_id} with API: {api_choice}, Model: {model}")
-                    st.session_state[analysis_result_key] = analysis
-                else:
-                    logger.warning(f"Analysis for image {section_id} returned no results")
-                    st.error("Failed to analyze the image. Please try again.")
+            submit_image_analysis(section_id, image_file, prompt, api_choice, model, temperature, top_p, max_tokens)
+
+        show_job_status(analysis_result_key, "Failed to analyze the image. Please try again.")
+
+        if prompt and analysis_result_key not in st.session_state:
+            offer_near_duplicate(section_id, image_file, prompt, api_choice, model)
 
         if analysis_result_key in st.session_state:
             st.subheader(f"Image {section_id} Analysis")
@@ -177,19 +370,53 @@ def analyze_image(section_id, image_file, api_choice, model, temperature, top_p,
             
             if st.button(f"Generate Final Content for Image {section_id}"):
                 generate_final_content(section_id, api_choice, model, temperature, top_p, max_tokens)
+            show_job_status(f"final_content_{section_id}", f"Failed to generate final content for Image {section_id}")
+            if f"final_content_{section_id}" in st.session_state:
+                st.subheader(f"Final Content for Image {section_id}")
+                st.write(st.session_state[f"final_content_{section_id}"])
+
 
+def keep_offpage_widget_state():
+    # Streamlit drops the state of widgets that were not rendered in a run, which would lose the
+    # prompts and captions of every image outside the current gallery page.
+    for key in list(st.session_state.keys()):
+        if key.startswith(PER_IMAGE_WIDGET_PREFIXES):
+            st.session_state[key] = st.session_state[key]
+
+
+def show_gallery(uploaded_files, api_choice, model, temperature, top_p, max_tokens):
+    pages = max(1, -(-len(uploaded_files) // GALLERY_PAGE_SIZE))
+    analyzed = sum(f"analysis_{i + 1}" in st.session_state for i in range(len(uploaded_files)))
+    if pages > 1:
+        # The page is set only through session state; also passing value= makes Streamlit warn on every change.
+        if "gallery_page" not in st.session_state or st.session_state["gallery_page"] > pages:
+            st.session_state["gallery_page"] = min(st.session_state.get("gallery_page", 1), pages)
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, step=1, key="gallery_page")
+    else:
+        page = 1
+    start = (page - 1) * GALLERY_PAGE_SIZE
+    visible = uploaded_files[start:start + GALLERY_PAGE_SIZE]
+    st.caption(f"Images {start + 1}–{start + len(visible)} of {len(uploaded_files)} · {analyzed} analyzed")
+
+    # Only the images on this page get widgets, so a rerun costs the same however many are uploaded.
+    for row_start in range(0, len(visible), GALLERY_COLUMNS):
+        cols = st.columns(GALLERY_COLUMNS)
+        for offset, file in enumerate(visible[row_start:row_start + GALLERY_COLUMNS]):
+            with cols[offset]:
+                analyze_image(start + row_start + offset + 1, file, api_choice, model, temperature, top_p, max_tokens)
 
 
 def main():
     page_setup()
     api_choice, model, temperature, top_p, max_tokens = get_api_info()
+    show_resilience_options()
 
+    # The Gemini SDK configures itself from GEMINI_API_KEY when first loaded (see utils.sdk).
     if api_choice == "Gemini":
         GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
         if GEMINI_API_KEY is None:
             st.error("GEMINI_API_KEY environment variable is not set")
             return
-        genai.configure(api_key=GEMINI_API_KEY)
     elif api_choice == "OpenAI":
         OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
         if OPENAI_API_KEY is None:
@@ -201,26 +428,39 @@ def main():
             st.error("ANTHROPIC_API_KEY environment variable is not set")
             return
 
+    keep_offpage_widget_state()
+    collect_finished_jobs()
+    active = sum(not job.finished for job in jobs.session_jobs(job_session()))
+    if active:
+        show_active_jobs(active)
+
     # Image upload section
     st.header("Upload Images")
-    uploaded_files = st.file_uploader("Choose up to 3 images", type=["png", "jpg", "jpeg"], accept_multiple_files=True)
+    uploaded_files = st.file_uploader("Choose images", type=["png", "jpg", "jpeg"], accept_multiple_files=True)
 
     if uploaded_files:
-        num_files = len(uploaded_files)
-        if num_files > 3:
-            st.warning("You can only upload up to 3 images. Only the first 3 will be processed.")
-            uploaded_files = uploaded_files[:3]
-        
-        cols = st.columns(3)
-        for i, file in enumerate(uploaded_files):
-            with cols[i]:
-                analyze_image(i+1, file, api_choice, model, temperature, top_p, max_tokens)
+        if st.button("🚀 Analyze All Images"):
+            analyze_all_images(uploaded_files, api_choice, model, temperature, top_p, max_tokens)
+
+        with st.expander("📦 Analyze all images in one request"):
+            shared_prompt = st.text_area(
+                "Shared prompt for all images", key="shared_prompt", height=100,
+                help="Sends every image with one prompt in a single request, which suits a set of related shots."
+            )
+            if st.button("Analyze Together"):
+                analyze_images_together(uploaded_files, shared_prompt, api_choice, model, temperature, top_p, max_tokens)
+
+        show_job_status(BATCH_JOB, "Failed to analyze the images together. Please try again.")
+        show_gallery(uploaded_files, api_choice, model, temperature, top_p, max_tokens)
 
     # Clear All button
     if st.button("🧹 Clear All"):
+        jobs.discard_session(job_session())
         for key in list(st.session_state.keys()):
             del st.session_state[key]
         st.rerun()
 
+    show_cache_stats()
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,156 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from utils.logger import setup_logger
+from utils.scheduler import StreamInterrupted
+
+logger = setup_logger(__name__)
+
+# CASSETTE_MODE=record captures every provider call made through process_*/stream_* into
+# CASSETTE_PATH; CASSETTE_MODE=replay serves them back without touching the network.
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off").lower()
+CASSETTE_PATH = os.getenv(
+    "CASSETTE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), ".cache", "cassette.jsonl.gz"),
+)
+# 0 replays instantly, 1 reproduces the recorded provider latency, 2 doubles it, and so on.
+CASSETTE_LATENCY_SCALE = float(os.getenv("CASSETTE_LATENCY_SCALE", "0"))
+
+_lock = threading.Lock()
+_entries = None
+_replay_counts = defaultdict(int)
+
+
+def enabled():
+    return CASSETTE_MODE in ("record", "replay")
+
+
+def digest(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data or b"").hexdigest()
+
+
+def request_key(kind, provider, model, request):
+    return digest(json.dumps([kind, provider, model, request], sort_keys=True, default=str))
+
+
+def call(kind, provider, model, request, fn):
+    if not enabled():
+        return fn()
+    key = request_key(kind, provider, model, request)
+    if CASSETTE_MODE == "replay":
+        entry = _next_entry(key, kind, provider, model)
+        if entry is None:
+            return None
+        _sleep_until(time.perf_counter(), entry["seconds"])
+        if "chunks" in entry:
+            return "".join(chunk for _, chunk in entry["chunks"]) or None
+        return entry["result"]
+
+    started = time.perf_counter()
+    result = fn()
+    _append({
+        "key": key, "kind": kind, "provider": provider, "model": model, "request": request,
+        "result": result, "seconds": round(time.perf_counter() - started, 4),
+    })
+    return result
+
+
+def stream(kind, provider, model, request, fn):
+    if not enabled():
+        yield from fn()
+        return
+    key = request_key(kind, provider, model, request)
+    if CASSETTE_MODE == "replay":
+        entry = _next_entry(key, kind, provider, model)
+        if entry is None:
+            return
+        started = time.perf_counter()
+        # A blocking recording replays as a single chunk delivered at the end.
+        chunks = entry["chunks"] if "chunks" in entry else [[entry["seconds"], entry["result"]]] if entry["result"] else []
+        for offset, chunk in chunks:
+            _sleep_until(started, offset)
+            yield chunk
+        _sleep_until(started, entry["seconds"])
+        if "error" in entry:
+            raise StreamInterrupted(entry["error"])
+        return
+
+    started = time.perf_counter()
+    chunks = []
+    error = None
+    abandoned = False
+    try:
+        for chunk in fn():
+            chunks.append([round(time.perf_counter() - started, 4), chunk])
+            yield chunk
+    except GeneratorExit:
+        # The caller stopped reading part-way; replaying the truncated output would pass it off as complete.
+        abandoned = True
+        logger.info(f"Not recording {kind} stream from {provider} ({model}) abandoned after {len(chunks)} chunks")
+        raise
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        if not abandoned:
+            entry = {
+                "key": key, "kind": kind, "provider": provider, "model": model, "request": request,
+                "chunks": chunks, "seconds": round(time.perf_counter() - started, 4),
+            }
+            if error is not None:
+                entry["error"] = error
+            _append(entry)
+
+
+def _sleep_until(started, offset):
+    if CASSETTE_LATENCY_SCALE > 0:
+        remaining = started + offset * CASSETTE_LATENCY_SCALE - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def _open(mode):
+    return gzip.open(CASSETTE_PATH, mode + "t", encoding="utf-8") if CASSETTE_PATH.endswith(".gz") else open(CASSETTE_PATH, mode, encoding="utf-8")
+
+
+def _append(entry):
+    line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+    with _lock:
+        os.makedirs(os.path.dirname(CASSETTE_PATH) or ".", exist_ok=True)
+        # Each append on a .gz path adds a gzip member; gzip.open reads them back as one stream.
+        with _open("a") as f:
+            f.write(line)
+
+
+def _load():
+    global _entries
+    if _entries is not None:
+        return _entries
+    entries = defaultdict(list)
+    if os.path.exists(CASSETTE_PATH):
+        with _open("r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entries[entry["key"]].append(entry)
+    logger.info(f"Loaded {sum(len(v) for v in entries.values())} cassette entries from {CASSETTE_PATH}")
+    _entries = entries
+    return _entries
+
+
+def _next_entry(key, kind, provider, model):
+    with _lock:
+        recorded = _load().get(key)
+        if not recorded:
+            logger.error(f"No cassette entry for {kind} call to {provider} ({model}) in {CASSETTE_PATH}")
+            return None
+        # Repeated identical requests cycle through their recordings in order, so replays are deterministic.
+        entry = recorded[_replay_counts[key] % len(recorded)]
+        _replay_counts[key] += 1
+        return entry
@@ -0,0 +1,245 @@
+import base64
+import os
+from io import BytesIO
+from utils import gemini_files, metrics, prompt_cache, sdk
+from utils.clients import get_anthropic_client, get_openai_client, get_together_client
+from utils.history import SUMMARY_ROLE, ConversationHistory
+from utils.image_processing import preprocess_image
+from utils.logger import setup_logger
+from utils.scheduler import call_with_retry, estimate_tokens
+from utils.text_processing import process_text
+
+logger = setup_logger(__name__)
+
+IMAGE_TURN_TEXT = "This is the image we will be discussing."
+IMAGE_ACK_TEXT = "I can see the image and will refer to it in my answers."
+SUMMARY_ACK_TEXT = "Understood, I will keep that context in mind."
+
+
+class ChatConversation:
+    """A multi-turn conversation sent in the provider's native structure.
+
+    Gemini uses a ChatSession; the other providers get a role-tagged message array. The image
+    and a pinned document, if any, are pinned once at the head of the history so they form a
+    stable prefix for the providers' prompt caches, and ConversationHistory decides which turns
+    are sent verbatim and which are folded into a summary.
+    """
+
+    def __init__(self, api_choice, model):
+        self.api_choice = api_choice
+        self.model = model
+        self.turns = []
+        self.image = None
+        self.document = None
+        self.history = ConversationHistory()
+        self._session = None
+        self._window = None
+        self._image_payloads = {}
+        self._file_handle = None
+
+    def set_model(self, api_choice, model):
+        if (api_choice, model) != (self.api_choice, self.model):
+            self.api_choice, self.model = api_choice, model
+            # The native session is rebuilt from the same turns on the next send.
+            self._session = None
+
+    def attach_image(self, data, media_type, name="image"):
+        self.image = {"data": data, "media_type": media_type, "name": name}
+        self._image_payloads = {}
+        self._file_handle = None
+        self._session = None
+
+    def attach_document(self, text):
+        if text != self.document:
+            self.document = text
+            self._session = None
+
+    def pins_document(self):
+        """Whether the attached document is pinned whole; otherwise callers pass retrieved chunks as context."""
+        return prompt_cache.pins_document(self.api_choice, self.model, self.document)
+
+    def caches_document(self):
+        """Whether the pinned document is also long enough for the provider to cache."""
+        return self.pins_document() and prompt_cache.caches_document(self.api_choice, self.model, self.document)
+
+    def send(self, text, temperature=None, top_p=None, max_tokens=None, context=None):
+        """Send one user turn and return the reply text, or None if nothing usable came back.
+
+        context (e.g. retrieved PDF chunks) accompanies this turn only and is not kept in the history.
+        """
+        message = f"{context}\n\n{text}" if context else text
+        window = self.history.context_messages(self.turns + [{"role": "user", "content": text}], self._summarize)
+        summary = window[0]["content"] if window and window[0]["role"] == SUMMARY_ROLE else None
+        recent = window[1:-1] if summary else window[:-1]
+        document = self.document if self.pins_document() else None
+        window_key = (summary, len(self.turns) - len(recent), document is not None)
+        # Native histories must alternate user/assistant, but the summary boundary can fall mid-turn.
+        reply_to_summary = SUMMARY_ACK_TEXT
+        while recent and recent[0]["role"] == "assistant":
+            reply_to_summary = recent[0]["content"]
+            recent = recent[1:]
+        prior = [{"role": "user", "content": f"Summary of earlier conversation: {summary}"},
+                 {"role": "assistant", "content": reply_to_summary}] if summary else []
+        prior += [{"role": turn["role"], "content": turn["content"]} for turn in recent]
+
+        logger.info(f"Sending chat turn {len(self.turns) // 2 + 1} to {self.api_choice} ({self.model}), {len(recent)} recent messages")
+        with metrics.track_call("chat", self.api_choice, self.model) as call:
+            try:
+                if self.api_choice == "Gemini":
+                    reply = self._send_gemini(window_key, document, prior, text, message, temperature, top_p, max_tokens)
+                else:
+                    reply = self._send_messages(document, prior, message, temperature, top_p, max_tokens)
+            except Exception as e:
+                logger.error(f"An error occurred while sending the chat turn to {self.api_choice}: {str(e)}")
+                # The session may hold a half-finished exchange; rebuild it from the turns next time.
+                self._session = None
+                reply = None
+            call["outcome"] = "ok" if reply else "error"
+        if reply:
+            self.turns.append({"role": "user", "content": text})
+            self.turns.append({"role": "assistant", "content": reply})
+        return reply
+
+    def _summarize(self, prompt):
+        return process_text(prompt, "", self.api_choice, self.model, 0.2, None, 1024)
+
+    def _image_payload(self, api_choice):
+        if api_choice not in self._image_payloads:
+            image_file = BytesIO(self.image["data"])
+            image_file.name = self.image["name"]
+            self._image_payloads[api_choice] = preprocess_image(image_file, "Gemini" if api_choice == "Meta-Llama" else api_choice)
+        return self._image_payloads[api_choice]
+
+    def _send_gemini(self, window_key, document, prior, text, message, temperature, top_p, max_tokens):
+        if self._session is not None and self._file_handle is not None and not gemini_files.touch(self._file_handle):
+            # The session outlived the uploaded image (idle reaper or expiry); start over with a fresh upload.
+            self._session = None
+        if self._session is None or window_key != self._window:
+            self._start_gemini_session(window_key, document, prior)
+        try:
+            response = self._send_gemini_message(message, temperature, top_p, max_tokens)
+        except Exception as e:
+            if self._file_handle is None or not gemini_files.file_rejected(e):
+                raise
+            logger.warning(f"Gemini no longer has chat image {self._file_handle.name}, re-uploading it: {str(e)}")
+            gemini_files.invalidate(self._file_handle)
+            self._start_gemini_session(window_key, document, prior)
+            response = self._send_gemini_message(message, temperature, top_p, max_tokens)
+        session = self._session
+        metrics.record_usage(getattr(response, "usage_metadata", None))
+        if not response.parts:
+            # Blocked or empty: drop the exchange so the session history stays coherent.
+            session.rewind()
+            return None
+        history = session.history
+        if message != text:
+            # Keep only the bare question in the history; context is retrieved afresh for each turn.
+            session.history = history[:-2] + [{"role": "user", "parts": [text]}, history[-1]]
+        return response.text
+
+    def _start_gemini_session(self, window_key, document, prior):
+        genai = sdk.load("Gemini")
+        history = []
+        self._file_handle = None
+        cached = None
+        if document and prompt_cache.caches_document("Gemini", self.model, document):
+            cached = prompt_cache.gemini_cached_content(self.model, document)
+        if document and cached is None:
+            history.append({"role": "user", "parts": [document, prompt_cache.DOCUMENT_TURN_TEXT]})
+            history.append({"role": "model", "parts": [prompt_cache.DOCUMENT_ACK_TEXT]})
+        if self.image is not None:
+            image = self._image_payload("Gemini")
+            # Uploaded once through the Files API; every later turn only carries the file reference.
+            self._file_handle = gemini_files.get_file_handle(image["data"], image["media_type"])
+            history.append({"role": "user", "parts": [self._file_handle, IMAGE_TURN_TEXT]})
+            history.append({"role": "model", "parts": [IMAGE_ACK_TEXT]})
+        history += [{"role": "model" if turn["role"] == "assistant" else "user", "parts": [turn["content"]]} for turn in prior]
+        if cached is not None:
+            # The document turn lives in the cached content, so it is neither re-sent nor re-billed in full.
+            gemini_model = genai.GenerativeModel.from_cached_content(cached)
+        else:
+            gemini_model = genai.GenerativeModel(model_name=self.model)
+        self._session = gemini_model.start_chat(history=history)
+        self._window = window_key
+
+    def _send_gemini_message(self, message, temperature, top_p, max_tokens):
+        session = self._session
+        with metrics.stage("generate"):
+            response = call_with_retry(
+                "Gemini", self.model,
+                lambda timeout: session.send_message(
+                    message,
+                    generation_config={"temperature": temperature, "top_p": top_p, "max_output_tokens": max_tokens},
+                    request_options={"timeout": timeout},
+                ),
+                estimate_tokens(message, max_tokens=max_tokens)
+            )
+        return response
+
+    def _send_messages(self, document, prior, message, temperature, top_p, max_tokens):
+        # Pinned parts first and the new question last, so every turn shares the longest possible prefix.
+        messages = []
+        head = []
+        if self.image is not None and self.api_choice in ("OpenAI", "Claude"):
+            head += [self._image_block(), {"type": "text", "text": IMAGE_TURN_TEXT}]
+        if document:
+            head += [{"type": "text", "text": document}, {"type": "text", "text": prompt_cache.DOCUMENT_TURN_TEXT}]
+        if head:
+            if self.api_choice == "Claude":
+                head[-1] = prompt_cache.claude_breakpoint(head[-1])
+            messages += [{"role": "user", "content": head},
+                         {"role": "assistant", "content": prompt_cache.DOCUMENT_ACK_TEXT if document else IMAGE_ACK_TEXT}]
+        messages += prior
+        if self.api_choice == "Claude" and prior:
+            # A second breakpoint after the verbatim turns lets the next turn read the conversation from the cache too.
+            messages[-1] = {"role": messages[-1]["role"],
+                            "content": [prompt_cache.claude_breakpoint({"type": "text", "text": messages[-1]["content"]})]}
+        messages.append({"role": "user", "content": message})
+        estimated = estimate_tokens(
+            *(block.get("text") for m in messages for block in (m["content"] if isinstance(m["content"], list) else [{"text": m["content"]}])),
+            max_tokens=max_tokens
+        )
+
+        if self.api_choice == "Claude":
+            client = get_anthropic_client(os.getenv("ANTHROPIC_API_KEY"))
+            with metrics.stage("generate"):
+                response = call_with_retry(
+                    "Claude", self.model,
+                    lambda timeout: client.messages.create(
+                        model=self.model, max_tokens=max_tokens, messages=messages, timeout=timeout,
+                        **prompt_cache.claude_request_options()
+                    ),
+                    estimated
+                )
+            metrics.record_usage(response.usage)
+            return response.content[0].text if response.content else None
+
+        if self.api_choice == "OpenAI":
+            client = get_openai_client(os.getenv("OPENAI_API_KEY"))
+            messages.insert(0, {"role": "system", "content": "You are a helpful assistant."})
+            request = {"temperature": temperature}
+            per_request_timeout = True
+        else:
+            # Meta-Llama models on Together are text-only, so the image turn is left out.
+            client = get_together_client(os.getenv("TOGETHER_API_KEY"))
+            request = {"temperature": temperature, "top_p": top_p}
+            # The Together SDK has no per-request timeout; its calls are bounded by the client's CLIENT_TIMEOUT.
+            per_request_timeout = False
+        with metrics.stage("generate"):
+            response = call_with_retry(
+                self.api_choice, self.model,
+                lambda timeout: client.chat.completions.create(
+                    model=self.model, messages=messages, max_tokens=max_tokens,
+                    **request, **({"timeout": timeout} if per_request_timeout else {})
+                ),
+                estimated
+            )
+        metrics.record_usage(getattr(response, "usage", None))
+        return response.choices[0].message.content if response.choices else None
+
+    def _image_block(self):
+        image = self._image_payload(self.api_choice)
+        encoded = base64.b64encode(image["data"]).decode("utf-8")
+        if self.api_choice == "Claude":
+            return {"type": "image", "source": {"type": "base64", "media_type": image["media_type"], "data": encoded}}
+        return {"type": "image_url", "image_url": {"url": f"data:{image['media_type']};base64,{encoded}"}}
@@ -0,0 +1,110 @@
+import atexit
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from utils import sdk
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Connection pool sizing, shared by every client created through this module. SDK-level
+# retries are disabled because utils.scheduler owns retries and backoff.
+POOL_MAX_CONNECTIONS = int(os.getenv("CLIENT_POOL_MAX_CONNECTIONS", "20"))
+POOL_MAX_KEEPALIVE = int(os.getenv("CLIENT_POOL_MAX_KEEPALIVE", "10"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("CLIENT_POOL_KEEPALIVE_EXPIRY", "60"))
+CLIENT_TIMEOUT = float(os.getenv("CLIENT_TIMEOUT", "120"))
+
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+_clients = {}
+_lock = threading.Lock()
+_http_session = None
+
+
+def _httpx_client():
+    import httpx
+    return httpx.Client(
+        timeout=CLIENT_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        ),
+    )
+
+
+def _get_or_create(provider, api_key, factory):
+    key = (provider, api_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            logger.info(f"Creating pooled {provider} client")
+            client = factory()
+            _clients[key] = client
+    return client
+
+
+def get_http_session():
+    global _http_session
+    if _http_session is not None:
+        return _http_session
+    with _lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_MAX_KEEPALIVE, pool_maxsize=POOL_MAX_CONNECTIONS)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+    return _http_session
+
+
+def get_openai_client(api_key):
+    return _get_or_create(
+        "OpenAI",
+        api_key,
+        lambda: sdk.load("OpenAI").OpenAI(api_key=api_key, base_url=OPENAI_BASE_URL, http_client=_httpx_client(), max_retries=0),
+    )
+
+
+def get_anthropic_client(api_key):
+    return _get_or_create(
+        "Claude",
+        api_key,
+        lambda: sdk.load("Claude").Anthropic(api_key=api_key, http_client=_httpx_client(), max_retries=0),
+    )
+
+
+def get_together_client(api_key):
+    # The Together SDK keeps a requests session per thread unless one is supplied globally,
+    # so hand it the shared pooled session instead.
+    together = sdk.load("Meta-Llama")
+    together.requestssession = get_http_session()
+    return _get_or_create("Meta-Llama", api_key, lambda: together.Together(api_key=api_key, timeout=CLIENT_TIMEOUT, max_retries=0))
+
+
+def close_all_clients():
+    global _http_session
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        session = _http_session
+        _http_session = None
+    for client in clients:
+        close = getattr(client, "close", None)
+        if close is None:
+            continue
+        try:
+            close()
+        except Exception as e:
+            logger.warning(f"Failed to close client {type(client).__name__}: {str(e)}")
+    if session is not None:
+        session.close()
+    if clients or session is not None:
+        logger.info(f"Closed {len(clients)} pooled client(s)")
+
+
+atexit.register(close_all_clients)
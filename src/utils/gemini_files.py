@@ -0,0 +1,196 @@
+import hashlib
+import os
+import queue
+import tempfile
+import threading
+import time
+from utils import metrics, sdk
+from utils.logger import setup_logger
+from utils.scheduler import call_with_retry
+
+logger = setup_logger(__name__)
+
+# Gemini keeps uploaded files for 48 hours; reuse a handle until shortly before that.
+FILE_TTL_SECONDS = 47 * 3600
+EXPIRY_MARGIN_SECONDS = 300
+FILE_IDLE_SECONDS = int(os.getenv("GEMINI_FILE_IDLE_SECONDS", "3600"))
+REAPER_INTERVAL_SECONDS = int(os.getenv("GEMINI_FILE_REAPER_INTERVAL", "60"))
+
+# Images up to this size are sent inline with generate_content instead of through the Files API.
+INLINE_MAX_BYTES = int(os.getenv("GEMINI_INLINE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+POLL_INITIAL_DELAY = float(os.getenv("GEMINI_POLL_INITIAL_DELAY", "0.05"))
+POLL_MAX_DELAY = float(os.getenv("GEMINI_POLL_MAX_DELAY", "2.0"))
+POLL_TIMEOUT = float(os.getenv("GEMINI_POLL_TIMEOUT", "120"))
+
+# Uploads of different images share one of this many locks, so the lock table never grows.
+UPLOAD_LOCK_STRIPES = 64
+
+MEDIA_TYPE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+_handles = {}
+_upload_locks = [threading.Lock() for _ in range(UPLOAD_LOCK_STRIPES)]
+_lock = threading.Lock()
+_delete_queue = queue.Queue()
+_reaper = None
+
+
+def _digest(data):
+    digest = hashlib.sha256(data)
+    # Files belong to the API key that uploaded them.
+    digest.update((os.getenv("GEMINI_API_KEY") or "").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def make_image_part(data, media_type):
+    if len(data) <= INLINE_MAX_BYTES:
+        return {"mime_type": media_type, "data": data}, "inline"
+    return get_file_handle(data, media_type), "files"
+
+
+def get_file_handle(data, media_type):
+    digest = _digest(data)
+    handle = _cached_handle(digest)
+    if handle is not None:
+        logger.debug(f"Reusing Gemini file {handle.name}")
+        return handle
+
+    # Only one upload per distinct image, even when several sessions ask for it at once.
+    with _upload_locks[int(digest[:8], 16) % UPLOAD_LOCK_STRIPES]:
+        handle = _cached_handle(digest)
+        if handle is not None:
+            return handle
+        with metrics.stage("upload"):
+            handle = _upload(data, media_type)
+        with metrics.stage("poll"):
+            handle = wait_until_active(handle)
+        expiration = getattr(handle, "expiration_time", None)
+        expires_at = expiration.timestamp() if expiration else time.time() + FILE_TTL_SECONDS
+        with _lock:
+            _handles[digest] = {"file": handle, "expires_at": expires_at, "last_used": time.time()}
+        _ensure_reaper()
+        return handle
+
+
+def _cached_handle(digest):
+    now = time.time()
+    with _lock:
+        entry = _handles.get(digest)
+        if entry is None:
+            return None
+        if entry["expires_at"] - EXPIRY_MARGIN_SECONDS <= now:
+            del _handles[digest]
+            return None
+        entry["last_used"] = now
+        return entry["file"]
+
+
+def touch(handle):
+    """Mark a handle held elsewhere (e.g. in a chat session's history) as in use.
+
+    Returns False once the handle has been dropped or is about to expire, so the holder can fetch a fresh one.
+    """
+    now = time.time()
+    with _lock:
+        for entry in _handles.values():
+            if entry["file"].name == handle.name:
+                if entry["expires_at"] - EXPIRY_MARGIN_SECONDS <= now:
+                    return False
+                entry["last_used"] = now
+                return True
+    return False
+
+
+def file_rejected(error):
+    # google.api_core NotFound/PermissionDenied, matched by name so the SDK is not imported up front.
+    return type(error).__name__ in ("NotFound", "PermissionDenied")
+
+
+def _upload(data, media_type):
+    started = time.perf_counter()
+    suffix = MEDIA_TYPE_EXTENSIONS.get(media_type, "")
+    fd, path = tempfile.mkstemp(prefix="gemini-upload-", suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        # upload_file takes no timeout; the deadline still stops further attempts.
+        handle = call_with_retry("Gemini", "files", lambda timeout: sdk.load("Gemini").upload_file(path=path, mime_type=media_type))
+    finally:
+        os.remove(path)
+    logger.info(f"Uploaded {len(data)} bytes to Gemini as {handle.name} in {time.perf_counter() - started:.2f}s")
+    return handle
+
+
+def wait_until_active(handle):
+    started = time.monotonic()
+    delay = POLL_INITIAL_DELAY
+    while handle.state.name == "PROCESSING":
+        if time.monotonic() - started > POLL_TIMEOUT:
+            raise TimeoutError(f"Gemini file {handle.name} still processing after {POLL_TIMEOUT}s")
+        time.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+        handle = sdk.load("Gemini").get_file(handle.name)
+    if handle.state.name == "FAILED":
+        raise ValueError("Image processing failed")
+    logger.debug(f"Gemini file {handle.name} active after {time.monotonic() - started:.2f}s")
+    return handle
+
+
+def invalidate(handle):
+    with _lock:
+        for digest, entry in list(_handles.items()):
+            if entry["file"].name == handle.name:
+                del _handles[digest]
+    schedule_delete(handle.name)
+
+
+def schedule_delete(name):
+    _ensure_reaper()
+    _delete_queue.put(name)
+
+
+def _ensure_reaper():
+    global _reaper
+    with _lock:
+        if _reaper is None or not _reaper.is_alive():
+            _reaper = threading.Thread(target=_reaper_loop, name="gemini-file-reaper", daemon=True)
+            _reaper.start()
+
+
+def _reaper_loop():
+    last_sweep = time.monotonic()
+    while True:
+        try:
+            name = _delete_queue.get(timeout=REAPER_INTERVAL_SECONDS)
+        except queue.Empty:
+            name = None
+        if name is not None:
+            started = time.perf_counter()
+            try:
+                sdk.load("Gemini").delete_file(name)
+                logger.debug(f"Deleted Gemini file {name}")
+            except Exception as e:
+                logger.warning(f"Failed to delete Gemini file {name}: {str(e)}")
+            metrics.observe_stage("background", "Gemini", "files", "cleanup", time.perf_counter() - started)
+        if time.monotonic() - last_sweep >= REAPER_INTERVAL_SECONDS:
+            _sweep_idle_handles()
+            last_sweep = time.monotonic()
+
+
+def _sweep_idle_handles():
+    now = time.time()
+    with _lock:
+        stale = [
+            digest for digest, entry in _handles.items()
+            if now - entry["last_used"] > FILE_IDLE_SECONDS or entry["expires_at"] - EXPIRY_MARGIN_SECONDS <= now
+        ]
+        names = [_handles.pop(digest)["file"].name for digest in stale]
+    for name in names:
+        _delete_queue.put(name)
+    if names:
+        logger.info(f"Scheduled {len(names)} idle Gemini file(s) for deletion")
@@ -0,0 +1,141 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "10"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "15"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "1"))
+HEDGE_MAX_WORKERS = int(os.getenv("HEDGE_MAX_WORKERS", "16"))
+LATENCY_WINDOW = 200
+
+# Providers and the environment variable each needs before it can be used as a fallback.
+PROVIDER_API_KEYS = {
+    "Gemini": "GEMINI_API_KEY",
+    "OpenAI": "OPENAI_API_KEY",
+    "Claude": "ANTHROPIC_API_KEY",
+    "Meta-Llama": "TOGETHER_API_KEY",
+}
+VISION_CANDIDATES = [
+    ("Gemini", "gemini-1.5-flash"),
+    ("Gemini", "gemini-1.5-pro"),
+    ("OpenAI", "gpt-4o"),
+    ("OpenAI", "gpt-4o-mini"),
+    ("Claude", "claude-3-5-sonnet-20240620"),
+]
+TEXT_CANDIDATES = VISION_CANDIDATES + [
+    ("Meta-Llama", "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo"),
+]
+
+_stats = {}
+_stats_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=HEDGE_MAX_WORKERS, thread_name_prefix="hedge")
+
+
+def record_outcome(api_choice, model, seconds, ok):
+    with _stats_lock:
+        stats = _stats.setdefault((api_choice, model), {"latencies": deque(maxlen=LATENCY_WINDOW), "outcomes": deque(maxlen=LATENCY_WINDOW)})
+        if ok:
+            stats["latencies"].append(seconds)
+        stats["outcomes"].append(ok)
+
+
+def latency_percentile(api_choice, model, q):
+    with _stats_lock:
+        stats = _stats.get((api_choice, model))
+        latencies = sorted(stats["latencies"]) if stats else []
+    if len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def error_rate(api_choice, model):
+    with _stats_lock:
+        stats = _stats.get((api_choice, model))
+        outcomes = list(stats["outcomes"]) if stats else []
+    if not outcomes:
+        return 0.0
+    return 1 - sum(outcomes) / len(outcomes)
+
+
+def provider_available(api_choice):
+    return bool(os.getenv(PROVIDER_API_KEYS.get(api_choice, "")))
+
+
+def rank_candidates(candidates):
+    # Lowest error rate first, then fastest median; unmeasured candidates sort after measured ones.
+    def score(candidate):
+        p50 = latency_percentile(*candidate, 0.5)
+        return (round(error_rate(*candidate), 2), p50 is None, p50 or 0.0)
+    return sorted(candidates, key=score)
+
+
+def build_candidates(api_choice, model, pool, max_fallbacks=1):
+    fallbacks = [c for c in pool if c != (api_choice, model) and provider_available(c[0])]
+    return [(api_choice, model)] + rank_candidates(fallbacks)[:max_fallbacks]
+
+
+def hedge_delay(api_choice, model):
+    delay = latency_percentile(api_choice, model, HEDGE_PERCENTILE)
+    return max(HEDGE_MIN_DELAY, delay if delay is not None else HEDGE_DEFAULT_DELAY)
+
+
+def _attempt(fn, api_choice, model):
+    # Outcomes are recorded by the process_* functions themselves, which know about cache hits.
+    try:
+        return fn(api_choice, model)
+    except Exception as e:
+        logger.error(f"{api_choice} ({model}) raised during fallback call: {str(e)}")
+        return None
+
+
+def failover_call(candidates, fn):
+    for api_choice, model in candidates:
+        result = _attempt(fn, api_choice, model)
+        if result:
+            return result
+        logger.warning(f"{api_choice} ({model}) returned no result, failing over")
+    return None
+
+
+def hedged_call(candidates, fn):
+    pending = {}
+    remaining = list(candidates)
+    try:
+        while remaining or pending:
+            if remaining and (not pending or _should_hedge(pending)):
+                api_choice, model = remaining.pop(0)
+                if pending:
+                    logger.info(f"Hedging with {api_choice} ({model})")
+                pending[_executor.submit(_attempt, fn, api_choice, model)] = (api_choice, model)
+
+            timeout = hedge_delay(*next(iter(pending.values()))) if remaining else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                api_choice, model = pending.pop(future)
+                result = future.result()
+                if result:
+                    logger.info(f"Hedged request won by {api_choice} ({model})")
+                    return result
+        return None
+    finally:
+        # Threads already talking to a provider cannot be interrupted; their results are discarded.
+        for future in pending:
+            future.cancel()
+
+
+def _should_hedge(pending):
+    return all(not future.done() for future in pending)
+
+
+def call_with_fallback(candidates, fn, mode):
+    if mode == "hedge":
+        return hedged_call(candidates, fn)
+    if mode == "failover":
+        return failover_call(candidates, fn)
+    api_choice, model = candidates[0]
+    return _attempt(fn, api_choice, model)
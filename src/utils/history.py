@@ -0,0 +1,83 @@
+import os
+from utils.logger import setup_logger
+from utils.tokens import TokenTally, count_tokens
+
+logger = setup_logger(__name__)
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))
+# Turns are user/assistant message pairs.
+HISTORY_KEEP_TURNS = int(os.getenv("HISTORY_KEEP_TURNS", "4"))
+# Older messages are folded into the summary in batches of this many turns, so the extra
+# summarization call happens every few turns rather than on every one.
+HISTORY_SUMMARY_BATCH_TURNS = int(os.getenv("HISTORY_SUMMARY_BATCH_TURNS", "2"))
+SUMMARY_ROLE = "summary of earlier conversation"
+
+SUMMARY_PROMPT = """You maintain a running summary of a conversation between a user and an AI assistant.
+Update the summary with the new messages below. Keep every fact, decision, name, number and open question
+that later turns may rely on; drop pleasantries and repetition. Reply with the updated summary only.
+
+Current summary:
+{summary}
+
+New messages:
+{messages}"""
+
+
+def render(messages):
+    return "\n".join(f"{message['role'].capitalize()}: {message['content']}" for message in messages)
+
+
+class ConversationHistory:
+    """Keeps the last turns verbatim and folds older ones into an incrementally updated summary."""
+
+    def __init__(self, token_budget=HISTORY_TOKEN_BUDGET, keep_turns=HISTORY_KEEP_TURNS,
+                 batch_turns=HISTORY_SUMMARY_BATCH_TURNS, tokenizer="Gemini"):
+        self.token_budget = token_budget
+        self.keep_messages = keep_turns * 2
+        self.batch_messages = batch_turns * 2
+        self.tokenizer = tokenizer
+        self.summary = ""
+        self.summarized_upto = 0
+        # Each message is tokenized once, however many turns it stays in the window.
+        self.tally = TokenTally()
+
+    def context_messages(self, messages, summarize):
+        """Return the messages to send: a summary entry (if any) followed by the recent messages.
+
+        summarize(prompt) -> str or None is only called when the window has slid far enough.
+        """
+        if len(messages) < self.summarized_upto:
+            # The chat was cleared.
+            self.summary, self.summarized_upto = "", 0
+
+        self.tally.update(messages)
+        start = self.summarized_upto
+        over_turns = len(messages) - start > self.keep_messages + self.batch_messages
+        over_budget = self._tokens(messages, start) > self.token_budget and len(messages) - start > 2
+        if over_turns or over_budget:
+            self._fold(messages, len(messages) - min(self.keep_messages, len(messages) - start - 1), summarize)
+            start = self.summarized_upto
+
+        # Hard cap: if summarizing failed or the last turns alone are too long, drop the oldest verbatim messages.
+        budget = self.token_budget - count_tokens(self.summary, self.tokenizer)
+        while len(messages) - start > 1 and self._tokens(messages, start) > budget:
+            start += 1
+
+        prefix = [{"role": SUMMARY_ROLE, "content": self.summary}] if self.summary else []
+        return prefix + list(messages[start:])
+
+    def _fold(self, messages, upto, summarize):
+        folded = messages[self.summarized_upto:upto]
+        if not folded:
+            return
+        summary = summarize(SUMMARY_PROMPT.format(summary=self.summary or "(none yet)", messages=render(folded)))
+        if not summary:
+            logger.warning(f"Could not summarize {len(folded)} messages; keeping them verbatim for now")
+            return
+        self.summary = summary.strip()
+        self.summarized_upto = upto
+        logger.info(f"Folded {len(folded)} messages into the conversation summary ({len(self.summary)} chars)")
+
+    def _tokens(self, messages, start):
+        # Token count of messages[start:], from the tally.
+        return sum(self.tally.message_tokens(index, self.tokenizer) for index in range(start, len(messages)))
@@ -0,0 +1,273 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from io import BytesIO
+from itertools import combinations
+from pathlib import Path
+import numpy as np
+from PIL import Image, ImageOps
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+INDEX_PATH = os.getenv("IMAGE_INDEX_PATH", str(Path(__file__).parent.parent.parent / ".cache" / "image_index.sqlite3"))
+# "offer" shows earlier analyses of near-duplicates for reuse, "auto" reuses them in place of a
+# vision call, "off" disables the index.
+IMAGE_REUSE_MODE = os.getenv("IMAGE_REUSE_MODE", "offer")
+# Bits (out of 64) by which two pHashes may differ and still count as the same shot.
+IMAGE_INDEX_MAX_DISTANCE = int(os.getenv("IMAGE_INDEX_MAX_DISTANCE", "10"))
+# The dHash must agree too, which weeds out pHash collisions between different images.
+IMAGE_INDEX_MAX_DHASH_DISTANCE = int(os.getenv("IMAGE_INDEX_MAX_DHASH_DISTANCE", "12"))
+# Stored analyses expire like result cache entries, and the least recently matched go first above the size cap.
+IMAGE_INDEX_TTL_SECONDS = int(os.getenv("IMAGE_INDEX_TTL_SECONDS", str(30 * 24 * 3600)))
+IMAGE_INDEX_MAX_BYTES = int(os.getenv("IMAGE_INDEX_MAX_BYTES", str(64 * 1024 * 1024)))
+HASH_CACHE_SIZE = 1024
+
+BANDS = 4
+BAND_BITS = 64 // BANDS
+# New entries are scanned linearly until there are enough of them to be worth re-sorting the bands.
+PENDING_MAX = 1024
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_DCT_SIZE = 32
+_DCT = np.sqrt(2 / _DCT_SIZE) * np.cos(
+    np.pi * np.outer(np.arange(_DCT_SIZE), 2 * np.arange(_DCT_SIZE) + 1) / (2 * _DCT_SIZE)
+)
+_DCT[0] /= np.sqrt(2)
+
+_indexes = {}
+_hashes = OrderedDict()
+_lock = threading.Lock()
+_conn = None
+
+
+def _to_int(bits):
+    return int.from_bytes(np.packbits(bits.astype(np.uint8)).tobytes(), "big")
+
+
+def image_hashes(data):
+    """Return (phash, dhash) of an image as unsigned 64-bit ints; cached by content hash."""
+    digest = hashlib.sha256(data).hexdigest()
+    with _lock:
+        hashes = _hashes.get(digest)
+        if hashes is not None:
+            _hashes.move_to_end(digest)
+            return hashes
+
+    with Image.open(BytesIO(data)) as img:
+        # JPEG decoding at a reduced scale is far cheaper and all the hashes need is a thumbnail.
+        img.draft("L", (_DCT_SIZE * 2, _DCT_SIZE * 2))
+        gray = ImageOps.exif_transpose(img).convert("L")
+    pixels = np.asarray(gray.resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].ravel()
+    # The DC term only reflects overall brightness, so it is left out of the median.
+    phash = _to_int(low > np.median(low[1:]))
+    small = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    dhash = _to_int(small[:, 1:] > small[:, :-1])
+
+    with _lock:
+        _hashes[digest] = (phash, dhash)
+        while len(_hashes) > HASH_CACHE_SIZE:
+            _hashes.popitem(last=False)
+    return phash, dhash
+
+
+def _popcount(values):
+    return _POPCOUNT[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+@lru_cache(maxsize=None)
+def _band_masks(radius):
+    # Every 16-bit mask with at most radius bits set: the band values within that distance of a key.
+    masks = [0]
+    for bits in range(1, radius + 1):
+        masks += [sum(1 << b for b in combo) for combo in combinations(range(BAND_BITS), bits)]
+    return np.array(masks, dtype=np.uint16)
+
+
+class HashIndex:
+    """Multi-index hashing over 64-bit pHashes.
+
+    The hash is split into four 16-bit bands, each kept sorted. Two hashes within distance r
+    agree to within r // 4 bits on at least one band, so a search probes each band for those
+    few neighbouring values with searchsorted and only computes full distances for the hits.
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.phashes = np.empty(0, dtype=np.uint64)
+        self.dhashes = np.empty(0, dtype=np.uint64)
+        self.bands = []
+        self.pending = []
+
+    def __len__(self):
+        return len(self.ids) + len(self.pending)
+
+    def add(self, entry_id, phash, dhash):
+        self.pending.append((entry_id, phash, dhash))
+        if len(self.pending) >= PENDING_MAX:
+            self._merge()
+
+    def _merge(self):
+        ids, phashes, dhashes = zip(*self.pending)
+        self.ids = np.concatenate((self.ids, np.array(ids, dtype=np.int64)))
+        self.phashes = np.concatenate((self.phashes, np.array(phashes, dtype=np.uint64)))
+        self.dhashes = np.concatenate((self.dhashes, np.array(dhashes, dtype=np.uint64)))
+        self.pending = []
+        self.bands = []
+        for band in range(BANDS):
+            values = ((self.phashes >> np.uint64(band * BAND_BITS)) & np.uint64(0xFFFF)).astype(np.uint16)
+            order = np.argsort(values, kind="stable")
+            self.bands.append((values[order], order))
+
+    def search(self, phash, dhash, max_distance=IMAGE_INDEX_MAX_DISTANCE, max_dhash_distance=IMAGE_INDEX_MAX_DHASH_DISTANCE):
+        """Return [(entry_id, distance)] of entries within max_distance, nearest first."""
+        positions = [self._candidates(phash, max_distance)] if self.bands else []
+        ids = np.concatenate([self.ids[p] for p in positions] + [np.array([e[0] for e in self.pending], dtype=np.int64)])
+        phashes = np.concatenate([self.phashes[p] for p in positions] + [np.array([e[1] for e in self.pending], dtype=np.uint64)])
+        dhashes = np.concatenate([self.dhashes[p] for p in positions] + [np.array([e[2] for e in self.pending], dtype=np.uint64)])
+        distances = _popcount(phashes ^ np.uint64(phash))
+        dhash_distances = _popcount(dhashes ^ np.uint64(dhash))
+        keep = (distances <= max_distance) & (dhash_distances <= max_dhash_distance)
+        matches = sorted(zip(distances[keep].tolist(), ids[keep].tolist()))
+        return [(entry_id, distance) for distance, entry_id in matches]
+
+    def _candidates(self, phash, max_distance):
+        masks = _band_masks(max_distance // BANDS)
+        found = []
+        for band, (values, order) in enumerate(self.bands):
+            keys = np.uint16((phash >> (band * BAND_BITS)) & 0xFFFF) ^ masks
+            starts = np.searchsorted(values, keys, side="left")
+            lengths = np.searchsorted(values, keys, side="right") - starts
+            hit = lengths > 0
+            starts, lengths = starts[hit], lengths[hit]
+            # Expand the [start, start + length) runs into one array of positions.
+            offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            found.append(order[np.repeat(starts, lengths) + offsets])
+        return np.unique(np.concatenate(found))
+
+
+def _connection():
+    global _conn
+    if _conn is None:
+        Path(INDEX_PATH).parent.mkdir(parents=True, exist_ok=True)
+        _conn = sqlite3.connect(INDEX_PATH, check_same_thread=False, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "id INTEGER PRIMARY KEY, scope TEXT NOT NULL, phash INTEGER NOT NULL, dhash INTEGER NOT NULL, "
+            "name TEXT, analysis TEXT NOT NULL, created_at REAL NOT NULL, "
+            "size INTEGER NOT NULL DEFAULT 0, last_access REAL NOT NULL DEFAULT 0)"
+        )
+        columns = {row[1] for row in _conn.execute("PRAGMA table_info(images)")}
+        if "size" not in columns:
+            # Indexes created before pruning existed; their rows count from their creation time.
+            _conn.execute("ALTER TABLE images ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            _conn.execute("ALTER TABLE images ADD COLUMN last_access REAL NOT NULL DEFAULT 0")
+            _conn.execute("UPDATE images SET last_access = created_at, "
+                "size = LENGTH(CAST(analysis AS BLOB)) + LENGTH(CAST(COALESCE(name, '') AS BLOB)) + 48")
+        _conn.execute("CREATE INDEX IF NOT EXISTS images_scope ON images (scope)")
+        _conn.execute("CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access)")
+    return _conn
+
+
+def _signed(value):
+    # SQLite integers are signed 64-bit.
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _scope(prompt, api_choice, model):
+    return hashlib.sha256(repr((prompt.strip(), api_choice, model)).encode("utf-8")).hexdigest()
+
+
+def _index(scope):
+    # Callers hold _lock.
+    index = _indexes.get(scope)
+    if index is None:
+        started = time.perf_counter()
+        index = HashIndex()
+        rows = _connection().execute("SELECT id, phash, dhash FROM images WHERE scope = ?", (scope,)).fetchall()
+        for entry_id, phash, dhash in rows:
+            index.pending.append((entry_id, phash % (1 << 64), dhash % (1 << 64)))
+        if index.pending:
+            index._merge()
+        _indexes[scope] = index
+        logger.debug(f"Loaded {len(rows)} image hashes for scope {scope[:12]} in {time.perf_counter() - started:.3f}s")
+    return index
+
+
+def find_similar(data, prompt, api_choice, model):
+    """Return the earlier analysis of the nearest near-duplicate for this prompt and model, or None.
+
+    The result is a dict with name, analysis and distance (differing pHash bits).
+    """
+    if IMAGE_REUSE_MODE == "off" or not prompt:
+        return None
+    try:
+        phash, dhash = image_hashes(data)
+        with _lock:
+            matches = _index(_scope(prompt, api_choice, model)).search(phash, dhash)
+            if not matches:
+                return None
+            entry_id, distance = matches[0]
+            conn = _connection()
+            row = conn.execute("SELECT name, analysis FROM images WHERE id = ?", (entry_id,)).fetchone()
+            if row is None:
+                # Pruned by another process since this index was loaded.
+                _indexes.clear()
+                return None
+            conn.execute("UPDATE images SET last_access = ? WHERE id = ?", (time.time(), entry_id))
+        name, analysis = row
+        return {"name": name, "analysis": analysis, "distance": distance}
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Near-duplicate lookup failed: {str(e)}")
+        return None
+
+
+def add(data, name, prompt, api_choice, model, analysis):
+    if IMAGE_REUSE_MODE == "off" or not prompt or not analysis:
+        return
+    try:
+        phash, dhash = image_hashes(data)
+        scope = _scope(prompt, api_choice, model)
+        with _lock:
+            index = _index(scope)
+            if index.search(phash, dhash, max_distance=0, max_dhash_distance=0):
+                return
+            now = time.time()
+            conn = _connection()
+            cursor = conn.execute(
+                "INSERT INTO images (scope, phash, dhash, name, analysis, created_at, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (scope, _signed(phash), _signed(dhash), name, analysis, now, _entry_size(name, analysis), now),
+            )
+            index.add(cursor.lastrowid, phash, dhash)
+            _evict(conn, now)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Could not add {name} to the near-duplicate index: {str(e)}")
+
+
+def _entry_size(name, analysis):
+    # The analysis dominates; the hashes, timestamps and row overhead are counted as a flat 48 bytes.
+    return len(analysis.encode("utf-8")) + len((name or "").encode("utf-8")) + 48
+
+
+def _evict(conn, now):
+    # Callers hold _lock.
+    evicted = conn.execute("DELETE FROM images WHERE created_at < ?", (now - IMAGE_INDEX_TTL_SECONDS,)).rowcount
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+    if total > IMAGE_INDEX_MAX_BYTES:
+        for entry_id, size in conn.execute("SELECT id, size FROM images ORDER BY last_access").fetchall():
+            if total <= IMAGE_INDEX_MAX_BYTES:
+                break
+            conn.execute("DELETE FROM images WHERE id = ?", (entry_id,))
+            total -= size
+            evicted += 1
+    if evicted:
+        # The in-memory indexes still hold the removed ids; they are reloaded on next use.
+        _indexes.clear()
+        logger.info(f"Evicted {evicted} expired or least recently used near-duplicate index entries")
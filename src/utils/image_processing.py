@@ -1,104 +1,545 @@
 import base64
+import json
+import math
 import os
+import re
 import time
-import requests
-import google.generativeai as genai
-import anthropic
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from PIL import Image, ImageOps
+from utils import cassettes, gemini_files, image_index, metrics, result_cache, sdk
+from utils.hedging import VISION_CANDIDATES, build_candidates, call_with_fallback, record_outcome
+from utils.scheduler import StreamInterrupted, call_with_retry, estimate_tokens, stream_with_retry
+from utils.clients import OPENAI_BASE_URL, get_anthropic_client, get_http_session
 from utils.logger import setup_logger
+from utils.prompts import MULTI_IMAGE_PROMPT
 
-logger = setup_logger()
+logger = setup_logger(__name__)
 
-def process_image(image_file, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None):
+MAX_CONCURRENT_ANALYSES = int(os.getenv("MAX_CONCURRENT_ANALYSES", "8"))
+# Images sent together in one multi-image request, and the output budget shared between them.
+IMAGE_BATCH_SIZE = int(os.getenv("IMAGE_BATCH_SIZE", "8"))
+IMAGE_BATCH_MAX_OUTPUT_TOKENS = int(os.getenv("IMAGE_BATCH_MAX_OUTPUT_TOKENS", "4096"))
+
+# Largest image each provider actually looks at; anything bigger is resized server-side anyway.
+PROVIDER_MAX_DIMENSIONS = {
+    "Gemini": 3072,
+    "OpenAI": 2048,
+    "Claude": 1568,
+}
+OPENAI_SHORT_SIDE = 768
+CLAUDE_MAX_PIXELS = 1_150_000
+
+IMAGE_ENCODE_FORMAT = os.getenv("IMAGE_ENCODE_FORMAT", "JPEG").upper()
+IMAGE_ENCODE_QUALITY = int(os.getenv("IMAGE_ENCODE_QUALITY", "85"))
+
+def process_image(image_file, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None, use_cache=True):
+    api_choice = _vision_api(api_choice)
+    if api_choice is None:
+        return None
+
+    with metrics.track_call("image", api_choice, model) as call:
+        cache_key = _cache_key(image_file, prompt, api_choice, model, temperature, top_p, max_tokens) if use_cache else None
+        if cache_key:
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Result cache hit for {image_file.name}. API: {api_choice}, Model: {model}")
+                call["outcome"] = "cache_hit"
+                return cached
+            reused = _reuse_near_duplicate(image_file, prompt, api_choice, model)
+            if reused is not None:
+                call["outcome"] = "cache_hit"
+                return reused
+
+        started = time.perf_counter()
+        image = _prepare(image_file, prompt, api_choice)
+        result = cassettes.call(
+            "image", api_choice, model, _cassette_request(image, prompt, temperature, top_p, max_tokens),
+            lambda: _generate(image, prompt, api_choice, model, temperature, top_p, max_tokens)
+        )
+        record_outcome(api_choice, model, time.perf_counter() - started, bool(result))
+        call["outcome"] = "ok" if result else "error"
+
+        if cache_key and result:
+            result_cache.put(cache_key, result)
+        if result:
+            image_index.add(image_file.getvalue(), image_file.name, prompt, api_choice, model, result)
+        return result
+
+def process_image_with_fallback(image_file, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None, use_cache=True, mode="hedge"):
+    # mode is "hedge" (race a second provider after a latency-percentile delay) or "failover".
+    api_choice = _vision_api(api_choice)
+    if api_choice is None:
+        return None
+    candidates = build_candidates(api_choice, model, VISION_CANDIDATES)
+    return call_with_fallback(
+        candidates,
+        lambda api, candidate_model: process_image(
+            image_file, prompt, api, candidate_model, temperature, top_p, max_tokens, use_cache
+        ),
+        mode
+    )
+
+def stream_image(image_file, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None, use_cache=True):
+    api_choice = _vision_api(api_choice)
+    if api_choice is None:
+        return
+
+    with metrics.track_call("image", api_choice, model) as call:
+        cache_key = _cache_key(image_file, prompt, api_choice, model, temperature, top_p, max_tokens) if use_cache else None
+        if cache_key:
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Result cache hit for {image_file.name}. API: {api_choice}, Model: {model}")
+                call["outcome"] = "cache_hit"
+                yield cached
+                return
+            reused = _reuse_near_duplicate(image_file, prompt, api_choice, model)
+            if reused is not None:
+                call["outcome"] = "cache_hit"
+                yield reused
+                return
+
+        started = time.perf_counter()
+        image = _prepare(image_file, prompt, api_choice)
+        chunks = cassettes.stream(
+            "image", api_choice, model, _cassette_request(image, prompt, temperature, top_p, max_tokens),
+            lambda: _stream(image, prompt, api_choice, model, temperature, top_p, max_tokens)
+        )
+
+        parts = []
+        try:
+            for chunk in chunks:
+                if not parts:
+                    metrics.record_stage("first_token", time.perf_counter() - started)
+                parts.append(chunk)
+                yield chunk
+        except StreamInterrupted:
+            # The partial text is neither cached nor indexed; the caller sees the failure.
+            record_outcome(api_choice, model, time.perf_counter() - started, False)
+            raise
+        record_outcome(api_choice, model, time.perf_counter() - started, bool(parts))
+        call["outcome"] = "ok" if parts else "error"
+        if cache_key and parts:
+            result_cache.put(cache_key, "".join(parts))
+        if parts:
+            image_index.add(image_file.getvalue(), image_file.name, prompt, api_choice, model, "".join(parts))
+
+def _generate(image, prompt, api_choice, model, temperature, top_p, max_tokens):
     if api_choice == "Gemini":
-        return process_image_gemini(image_file, prompt, model, temperature, top_p, max_tokens)
-    elif api_choice == "OpenAI":
-        return process_image_openai(image_file, prompt, model, max_tokens)
-    elif api_choice == "Claude":
-        return process_image_claude(image_file, prompt, model, max_tokens)
-    elif api_choice == "Meta-Llama":
+        return process_image_gemini(image, prompt, model, temperature, top_p, max_tokens)
+    if api_choice == "OpenAI":
+        return process_image_openai(image, prompt, model, max_tokens)
+    return process_image_claude(image, prompt, model, max_tokens)
+
+def _stream(image, prompt, api_choice, model, temperature, top_p, max_tokens):
+    if api_choice == "Gemini":
+        return stream_image_gemini(image, prompt, model, temperature, top_p, max_tokens)
+    if api_choice == "OpenAI":
+        return stream_image_openai(image, prompt, model, max_tokens)
+    return stream_image_claude(image, prompt, model, max_tokens)
+
+def _cassette_request(image, prompt, temperature, top_p, max_tokens):
+    # Keyed on the preprocessed bytes actually sent; only their digest is stored.
+    return {
+        "image": cassettes.digest(image["data"]),
+        "media_type": image["media_type"],
+        "bytes": len(image["data"]),
+        "prompt": prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_tokens": max_tokens,
+    }
+
+def _prepare(image_file, prompt, api_choice):
+    with metrics.stage("preprocess"):
+        image = preprocess_image(image_file, api_choice)
+    metrics.record_bytes(len(image["data"]) + len(prompt.encode("utf-8")))
+    return image
+
+def _vision_api(api_choice):
+    if api_choice == "Meta-Llama":
         logger.info("Meta-Llama selected, defaulting to Gemini Vision for image processing")
-        return process_image_gemini(image_file, prompt, model, temperature, top_p, max_tokens)
-    else:
+        return "Gemini"
+    if api_choice not in PROVIDER_MAX_DIMENSIONS:
         logger.error(f"Unsupported API choice: {api_choice}")
         return None
+    return api_choice
+
+def _reuse_near_duplicate(image_file, prompt, api_choice, model):
+    # Re-cropped or re-compressed copies miss the exact-bytes cache but share a perceptual hash.
+    if image_index.IMAGE_REUSE_MODE != "auto":
+        return None
+    match = image_index.find_similar(image_file.getvalue(), prompt, api_choice, model)
+    if match is None:
+        return None
+    logger.info(f"Reusing the analysis of near-duplicate {match['name']} ({match['distance']} bits apart) for {image_file.name}")
+    return match["analysis"]
+
+def _cache_key(image_file, prompt, api_choice, model, temperature, top_p, max_tokens):
+    return result_cache.make_key("image", image_file.getvalue(), prompt, api_choice, model, temperature, top_p, max_tokens)
 
-def process_image_gemini(image_file, prompt, model, temperature, top_p, max_tokens):
+def detect_media_type(data):
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+def target_dimensions(width, height, api_choice):
+    scale = min(1.0, PROVIDER_MAX_DIMENSIONS[api_choice] / max(width, height))
+    if api_choice == "OpenAI":
+        # High-detail images are fitted into 2048x2048, then the short side is capped at 768.
+        scale = min(scale, OPENAI_SHORT_SIDE / min(width, height))
+    elif api_choice == "Claude":
+        scale = min(scale, math.sqrt(CLAUDE_MAX_PIXELS / (width * height)))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def estimate_image_tokens(width, height, api_choice):
+    if api_choice == "OpenAI":
+        width, height = target_dimensions(width, height, api_choice)
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+    elif api_choice == "Claude":
+        width, height = target_dimensions(width, height, api_choice)
+        return math.ceil(width * height / 750)
+    # Gemini 1.5 bills a flat rate per image regardless of resolution.
+    return 258
+
+def _encode(img, media_type):
+    output = BytesIO()
+    if media_type == "image/webp":
+        img.save(output, format="WEBP", quality=IMAGE_ENCODE_QUALITY)
+    else:
+        if img.mode != "RGB":
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A") if "A" in img.getbands() else None)
+            img = background
+        img.save(output, format="JPEG", quality=IMAGE_ENCODE_QUALITY, optimize=True)
+    return output.getvalue()
+
+def preprocess_image(image_file, api_choice):
+    data = image_file.getvalue()
+    media_type = detect_media_type(data)
+    image = {
+        "name": image_file.name,
+        "data": data,
+        "media_type": media_type or "image/jpeg",
+        "original_bytes": len(data),
+        "bytes_saved": 0,
+        "estimated_tokens": None,
+        "tokens_saved": 0,
+    }
     try:
-        logger.info(f"Starting image processing with Gemini. Model: {model}, Temperature: {temperature}, Top P: {top_p}, Max Tokens: {max_tokens}")
-        with open(image_file.name, "wb") as f:
-            f.write(image_file.getbuffer())
-        logger.debug(f"Image saved temporarily as {image_file.name}")
-        uploaded_image = genai.upload_file(path=image_file.name)
-        logger.debug(f"Image uploaded to Gemini API")
-        while uploaded_image.state.name == "PROCESSING":
-            time.sleep(2)
-            uploaded_image = genai.get_file(uploaded_image.name)
-        if uploaded_image.state.name == "FAILED":
-            raise ValueError("Image processing failed")
-        logger.info("Image processed successfully by Gemini API")
-        gemini_model = genai.GenerativeModel(model_name=model)
-        response = gemini_model.generate_content(
-            [uploaded_image, prompt],
-            generation_config={
-                "temperature": temperature,
-                "top_p": top_p,
-                "max_output_tokens": max_tokens,
-            },
-            request_options={"timeout": 120}
+        with Image.open(BytesIO(data)) as img:
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+            width, height = img.size
+            new_width, new_height = target_dimensions(width, height, api_choice)
+            resized = (new_width, new_height) != (width, height)
+            if resized:
+                img = img.resize((new_width, new_height), Image.LANCZOS)
+
+            encode_type = "image/webp" if IMAGE_ENCODE_FORMAT == "WEBP" else "image/jpeg"
+            encoded = _encode(img, encode_type)
+            if resized or media_type is None or len(encoded) < len(data):
+                image["data"] = encoded
+                image["media_type"] = encode_type
+
+        image["bytes_saved"] = len(data) - len(image["data"])
+        image["estimated_tokens"] = estimate_image_tokens(new_width, new_height, api_choice)
+        image["tokens_saved"] = estimate_image_tokens(width, height, api_choice) - image["estimated_tokens"]
+        logger.info(
+            f"Preprocessed {image_file.name} for {api_choice}: {width}x{height} -> {new_width}x{new_height}, "
+            f"{len(data)} -> {len(image['data'])} bytes ({image['bytes_saved']} saved), "
+            f"~{image['estimated_tokens']} tokens ({image['tokens_saved']} saved)"
         )
-        logger.info("Content generated successfully by Gemini model")
-        os.remove(image_file.name)
-        genai.delete_file(uploaded_image.name)
-        logger.debug("Temporary image file and uploaded image deleted")
-        return response.text if response and response.parts else None
     except Exception as e:
-        logger.error(f"An error occurred while processing the image with Gemini: {str(e)}")
-        if os.path.exists(image_file.name):
-            os.remove(image_file.name)
-            logger.debug("Temporary image file deleted after error")
-        return None
+        logger.warning(f"Could not preprocess {image_file.name}, sending original bytes: {str(e)}")
+    return image
+
+def process_images_batched(jobs, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None, use_cache=True):
+    # jobs is a list of (key, image_file); all share prompt. Yields (key, result) as each request completes.
+    api_choice = _vision_api(api_choice)
+    if api_choice is None or not jobs:
+        return
+    groups = [jobs[start:start + IMAGE_BATCH_SIZE] for start in range(0, len(jobs), IMAGE_BATCH_SIZE)]
+    logger.info(f"Analyzing {len(jobs)} images in {len(groups)} multi-image request(s). API: {api_choice}, Model: {model}")
+    with ThreadPoolExecutor(max_workers=min(len(groups), MAX_CONCURRENT_ANALYSES), thread_name_prefix="analyze") as executor:
+        futures = {
+            executor.submit(_process_group, group, prompt, api_choice, model, temperature, top_p, max_tokens, use_cache): group
+            for group in groups
+        }
+        for future in as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.error(f"Multi-image analysis failed: {str(e)}")
+                results = [None] * len(futures[future])
+            missing = [(key, image_file) for (key, image_file), result in zip(futures[future], results) if not result]
+            for (key, _), result in zip(futures[future], results):
+                if result:
+                    yield key, result
+            if missing:
+                # Whatever the combined answer left out is analyzed one image at a time.
+                logger.warning(f"Multi-image response covered {len(results) - len(missing)} of {len(results)} images, analyzing the rest individually")
+                for key, image_file in missing:
+                    yield key, process_image(image_file, prompt, api_choice, model, temperature, top_p, max_tokens, use_cache)
+
+def _process_group(group, prompt, api_choice, model, temperature, top_p, max_tokens, use_cache):
+    with metrics.track_call("image_batch", api_choice, model) as call:
+        batch_prompt = MULTI_IMAGE_PROMPT.format(count=len(group), prompt=prompt)
+        # The output budget is per image, but one response now carries all of them.
+        batch_tokens = min((max_tokens or 0) * len(group), IMAGE_BATCH_MAX_OUTPUT_TOKENS) or None
+        cache_key = None
+        if use_cache:
+            cache_key = result_cache.make_key(
+                "image_batch", *(image_file.getvalue() for _, image_file in group),
+                prompt, api_choice, model, temperature, top_p, max_tokens
+            )
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Result cache hit for a {len(group)}-image request. API: {api_choice}, Model: {model}")
+                call["outcome"] = "cache_hit"
+                return json.loads(cached)
+
+        images = [_prepare(image_file, "", api_choice) for _, image_file in group]
+        metrics.record_bytes(len(batch_prompt.encode("utf-8")))
+        response = cassettes.call(
+            "image_batch", api_choice, model,
+            {"images": [cassettes.digest(image["data"]) for image in images], "prompt": batch_prompt,
+             "temperature": temperature, "top_p": top_p, "max_tokens": batch_tokens},
+            lambda: _generate_batch(images, batch_prompt, api_choice, model, temperature, top_p, batch_tokens)
+        )
+        results = split_batch_response(response, len(group))
+        call["outcome"] = "ok" if all(results) else "error"
 
-def process_image_openai(image_file, prompt, model, max_tokens):
+        if all(results):
+            if cache_key:
+                result_cache.put(cache_key, json.dumps(results))
+            for (_, image_file), result in zip(group, results):
+                image_index.add(image_file.getvalue(), image_file.name, prompt, api_choice, model, result)
+        return results
+
+def split_batch_response(text, count):
+    """Return the per-image analyses of a multi-image JSON response, with None for any it is missing."""
+    results = [None] * count
+    if not text:
+        return results
+    # Models sometimes wrap JSON in a Markdown code fence despite being asked not to.
+    match = re.search(r"\{.*\}", text, re.DOTALL)
     try:
-        logger.info(f"Starting image processing with OpenAI. Model: {model}, Max Tokens: {max_tokens}")
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            logger.error("OPENAI_API_KEY environment variable is not set")
-            raise ValueError("OPENAI_API_KEY environment variable is not set")
+        analyses = json.loads(match.group(0))["analyses"] if match else []
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Could not parse the multi-image response: {str(e)}")
+        return results
+    for position, entry in enumerate(analyses):
+        if not isinstance(entry, dict) or not entry.get("analysis"):
+            continue
+        try:
+            index = int(entry.get("image", position + 1)) - 1
+        except (TypeError, ValueError):
+            index = position
+        if 0 <= index < count and results[index] is None:
+            results[index] = str(entry["analysis"]).strip()
+    return results
 
-        base64_image = base64.b64encode(image_file.getvalue()).decode('utf-8')
-        logger.debug("Image encoded to base64")
+def _generate_batch(images, prompt, api_choice, model, temperature, top_p, max_tokens):
+    if api_choice == "Gemini":
+        return process_images_gemini(images, prompt, model, temperature, top_p, max_tokens)
+    if api_choice == "OpenAI":
+        return process_images_openai(images, prompt, model, max_tokens)
+    return process_images_claude(images, prompt, model, max_tokens)
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
+def _batch_request_tokens(images, prompt, max_tokens):
+    return estimate_tokens(prompt, max_tokens=max_tokens) + sum(image.get("estimated_tokens") or 0 for image in images)
+
+def process_images_gemini(images, prompt, model, temperature, top_p, max_tokens):
+    try:
+        logger.info(f"Starting multi-image processing with Gemini. Model: {model}, Images: {len(images)}, Max Tokens: {max_tokens}")
+        # Shared instructions first, then each image after its label.
+        parts = [prompt]
+        for number, image in enumerate(images, start=1):
+            image_part, _ = gemini_files.make_image_part(image["data"], image["media_type"])
+            parts += [f"Image {number}:", image_part]
+        gemini_model = sdk.load("Gemini").GenerativeModel(model_name=model)
+        with metrics.stage("generate"):
+            response = call_with_retry(
+                "Gemini", model,
+                lambda timeout: gemini_model.generate_content(
+                    parts,
+                    generation_config={
+                        "temperature": temperature,
+                        "top_p": top_p,
+                        "max_output_tokens": max_tokens,
+                        "response_mime_type": "application/json",
+                    },
+                    request_options={"timeout": timeout}
+                ),
+                _batch_request_tokens(images, prompt, max_tokens)
+            )
+        metrics.record_usage(getattr(response, "usage_metadata", None))
+        return response.text if response and response.parts else None
+    except Exception as e:
+        logger.error(f"An error occurred while processing the images with Gemini: {str(e)}")
+        return None
 
+def process_images_openai(images, prompt, model, max_tokens):
+    try:
+        logger.info(f"Starting multi-image processing with OpenAI. Model: {model}, Images: {len(images)}, Max Tokens: {max_tokens}")
+        headers = _openai_headers()
+        content = [{"type": "text", "text": prompt}]
+        for number, image in enumerate(images, start=1):
+            base64_image = base64.b64encode(image["data"]).decode('utf-8')
+            content += [
+                {"type": "text", "text": f"Image {number}:"},
+                {"type": "image_url", "image_url": {"url": f"data:{image['media_type']};base64,{base64_image}"}},
+            ]
         payload = {
             "model": model,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": max_tokens
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": max_tokens,
+            "response_format": {"type": "json_object"},
         }
 
+        def post(timeout):
+            response = get_http_session().post(f"{OPENAI_BASE_URL}/chat/completions", headers=headers, json=payload, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+
+        with metrics.stage("generate"):
+            response_json = call_with_retry("OpenAI", model, post, _batch_request_tokens(images, prompt, max_tokens))
+        metrics.record_usage(response_json.get("usage"))
+        choices = response_json.get("choices") or []
+        return choices[0]["message"]["content"] if choices else None
+    except Exception as e:
+        logger.error(f"An error occurred while processing the images with OpenAI: {str(e)}")
+        return None
+
+def process_images_claude(images, prompt, model, max_tokens):
+    try:
+        logger.info(f"Starting multi-image processing with Claude. Model: {model}, Images: {len(images)}, Max Tokens: {max_tokens}")
+        client = _claude_client()
+        content = [{"type": "text", "text": prompt}]
+        for number, image in enumerate(images, start=1):
+            content += [
+                {"type": "text", "text": f"Image {number}:"},
+                {"type": "image", "source": {
+                    "type": "base64", "media_type": image["media_type"],
+                    "data": base64.b64encode(image["data"]).decode('utf-8'),
+                }},
+            ]
+        with metrics.stage("generate"):
+            message = call_with_retry(
+                "Claude", model,
+                lambda timeout: client.messages.create(model=model, max_tokens=max_tokens, messages=[{"role": "user", "content": content}], timeout=timeout),
+                _batch_request_tokens(images, prompt, max_tokens)
+            )
+        metrics.record_usage(message.usage)
+        return message.content[0].text if message.content else None
+    except Exception as e:
+        logger.error(f"An error occurred while processing the images with Claude: {str(e)}")
+        return None
+
+def process_image_gemini(image, prompt, model, temperature, top_p, max_tokens):
+    uploaded_image = None
+    try:
+        logger.info(f"Starting image processing with Gemini. Model: {model}, Temperature: {temperature}, Top P: {top_p}, Max Tokens: {max_tokens}")
+        started = time.perf_counter()
+        image_part, path = gemini_files.make_image_part(image["data"], image["media_type"])
+        if path == "files":
+            uploaded_image = image_part
+        prepared = time.perf_counter()
+        gemini_model = sdk.load("Gemini").GenerativeModel(model_name=model)
+        with metrics.stage("generate"):
+            response = call_with_retry(
+                "Gemini", model,
+                lambda timeout: gemini_model.generate_content(
+                    [image_part, prompt],
+                    generation_config={
+                        "temperature": temperature,
+                        "top_p": top_p,
+                        "max_output_tokens": max_tokens,
+                    },
+                    request_options={"timeout": timeout}
+                ),
+                _image_request_tokens(image, prompt, max_tokens)
+            )
+        metrics.record_usage(getattr(response, "usage_metadata", None))
+        logger.info(
+            f"Content generated successfully by Gemini model via {path} path "
+            f"({len(image['data'])} bytes): prepare {prepared - started:.3f}s, "
+            f"generate {time.perf_counter() - prepared:.3f}s"
+        )
+        return response.text if response and response.parts else None
+    except Exception as e:
+        if uploaded_image is not None and gemini_files.file_rejected(e):
+            logger.error(f"Gemini rejected uploaded file, it will be re-uploaded next time: {str(e)}")
+            gemini_files.invalidate(uploaded_image)
+        else:
+            logger.error(f"An error occurred while processing the image with Gemini: {str(e)}")
+        return None
+
+def stream_image_gemini(image, prompt, model, temperature, top_p, max_tokens):
+    uploaded_image = None
+    try:
+        logger.info(f"Starting streamed image processing with Gemini. Model: {model}, Temperature: {temperature}, Top P: {top_p}, Max Tokens: {max_tokens}")
+        image_part, path = gemini_files.make_image_part(image["data"], image["media_type"])
+        if path == "files":
+            uploaded_image = image_part
+        gemini_model = sdk.load("Gemini").GenerativeModel(model_name=model)
+
+        def generate(timeout):
+            response = gemini_model.generate_content(
+                [image_part, prompt],
+                generation_config={
+                    "temperature": temperature,
+                    "top_p": top_p,
+                    "max_output_tokens": max_tokens,
+                },
+                request_options={"timeout": timeout},
+                stream=True
+            )
+            chunk = None
+            for chunk in response:
+                if chunk.parts:
+                    yield chunk.text
+            metrics.record_usage(getattr(chunk, "usage_metadata", None))
+
+        with metrics.stage("generate"):
+            yield from stream_with_retry(
+                "Gemini", model, generate, _image_request_tokens(image, prompt, max_tokens)
+            )
+        logger.info(f"Content streamed successfully by Gemini model via {path} path")
+    except StreamInterrupted as e:
+        logger.error(f"Stream interrupted, discarding the partial response: {str(e)}")
+        raise
+    except Exception as e:
+        if uploaded_image is not None and gemini_files.file_rejected(e):
+            logger.error(f"Gemini rejected uploaded file, it will be re-uploaded next time: {str(e)}")
+            gemini_files.invalidate(uploaded_image)
+        else:
+            logger.error(f"An error occurred while streaming the image analysis from Gemini: {str(e)}")
+
+def process_image_openai(image, prompt, model, max_tokens):
+    try:
+        logger.info(f"Starting image processing with OpenAI. Model: {model}, Max Tokens: {max_tokens}")
         logger.debug("Sending request to OpenAI API")
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        response_json = response.json()
+        headers = _openai_headers()
+        payload = _openai_payload(image, prompt, model, max_tokens)
+
+        def post(timeout):
+            response = get_http_session().post(f"{OPENAI_BASE_URL}/chat/completions", headers=headers, json=payload, timeout=timeout)
+            response.raise_for_status()
+            return response.json()
+
+        with metrics.stage("generate"):
+            response_json = call_with_retry("OpenAI", model, post, _image_request_tokens(image, prompt, max_tokens))
+        metrics.record_usage(response_json.get("usage"))
         
         if 'choices' in response_json and len(response_json['choices']) > 0:
             logger.info("Successfully received response from OpenAI API")
@@ -110,47 +551,139 @@ def process_image_openai(image_file, prompt, model, max_tokens):
         logger.error(f"An error occurred while processing the image with OpenAI: {str(e)}")
         return None
 
-def process_image_claude(image_file, prompt, model, max_tokens):
+def stream_image_openai(image, prompt, model, max_tokens):
     try:
-        logger.info(f"Using Claude model: {model} with max_tokens {max_tokens}")
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
+        logger.info(f"Starting streamed image processing with OpenAI. Model: {model}, Max Tokens: {max_tokens}")
+        headers = _openai_headers()
+        payload = _openai_payload(image, prompt, model, max_tokens)
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
 
-        client = anthropic.Anthropic(api_key=api_key)
+        def post(timeout):
+            with get_http_session().post(
+                f"{OPENAI_BASE_URL}/chat/completions", headers=headers, json=payload, stream=True, timeout=timeout
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line.startswith(b"data: "):
+                        continue
+                    data = line[len(b"data: "):]
+                    if data == b"[DONE]":
+                        break
+                    event = json.loads(data)
+                    choices = event.get("choices") or []
+                    if choices and choices[0].get("delta", {}).get("content"):
+                        yield choices[0]["delta"]["content"]
+                    metrics.record_usage(event.get("usage"))
 
-        file_extension = image_file.name.split('.')[-1].lower()
-        media_type = f"image/{file_extension}"
-        if file_extension == 'jpg':
-            media_type = "image/jpeg"
+        with metrics.stage("generate"):
+            yield from stream_with_retry("OpenAI", model, post, _image_request_tokens(image, prompt, max_tokens))
+        logger.info("Successfully streamed response from OpenAI API")
+    except StreamInterrupted as e:
+        logger.error(f"Stream interrupted, discarding the partial response: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred while streaming the image analysis from OpenAI: {str(e)}")
 
-        base64_image = base64.b64encode(image_file.getvalue()).decode('utf-8')
+def _image_request_tokens(image, prompt, max_tokens):
+    return estimate_tokens(prompt, max_tokens=max_tokens) + (image.get("estimated_tokens") or 0)
 
-        message = client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": media_type,
-                                "data": base64_image,
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": prompt
+def _openai_headers():
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        logger.error("OPENAI_API_KEY environment variable is not set")
+        raise ValueError("OPENAI_API_KEY environment variable is not set")
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}"
+    }
+
+def _openai_payload(image, prompt, model, max_tokens):
+    base64_image = base64.b64encode(image["data"]).decode('utf-8')
+    logger.debug("Image encoded to base64")
+    return {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{image['media_type']};base64,{base64_image}"
                         }
-                    ],
-                }
-            ],
-        )
+                    }
+                ]
+            }
+        ],
+        "max_tokens": max_tokens
+    }
+
+def process_image_claude(image, prompt, model, max_tokens):
+    try:
+        logger.info(f"Using Claude model: {model} with max_tokens {max_tokens}")
+        client = _claude_client()
+        messages = _claude_messages(image, prompt)
+        with metrics.stage("generate"):
+            message = call_with_retry(
+                "Claude", model,
+                lambda timeout: client.messages.create(model=model, max_tokens=max_tokens, messages=messages, timeout=timeout),
+                _image_request_tokens(image, prompt, max_tokens)
+            )
+        metrics.record_usage(message.usage)
 
         return message.content[0].text
     except Exception as e:
         logger.error(f"An error occurred while processing the image with Claude: {str(e)}")
         return None
+
+def stream_image_claude(image, prompt, model, max_tokens):
+    try:
+        logger.info(f"Streaming from Claude model: {model} with max_tokens {max_tokens}")
+        client = _claude_client()
+        messages = _claude_messages(image, prompt)
+
+        def generate(timeout):
+            with client.messages.stream(model=model, max_tokens=max_tokens, messages=messages, timeout=timeout) as stream:
+                yield from stream.text_stream
+                metrics.record_usage(stream.get_final_message().usage)
+
+        with metrics.stage("generate"):
+            yield from stream_with_retry("Claude", model, generate, _image_request_tokens(image, prompt, max_tokens))
+    except StreamInterrupted as e:
+        logger.error(f"Stream interrupted, discarding the partial response: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred while streaming the image analysis from Claude: {str(e)}")
+
+def _claude_client():
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
+    return get_anthropic_client(api_key)
+
+def _claude_messages(image, prompt):
+    base64_image = base64.b64encode(image["data"]).decode('utf-8')
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": image["media_type"],
+                        "data": base64_image,
+                    },
+                },
+                {
+                    "type": "text",
+                    "text": prompt
+                }
+            ],
+        }
+    ]
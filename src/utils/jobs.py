@@ -0,0 +1,138 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Provider calls run here rather than in the Streamlit script thread, so reruns neither block on
+# them nor abort them.
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", "8"))
+# Finished jobs nobody collected (e.g. the browser tab was closed) are dropped after this long.
+JOBS_RETENTION_SECONDS = int(os.getenv("JOBS_RETENTION_SECONDS", "3600"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_jobs = {}
+_lock = threading.Lock()
+_executor = None
+
+
+class Job:
+    """One unit of background work, keyed by (session_id, name).
+
+    The work function receives the job and may call report() with progress (0..1) and partial
+    output, or append() streamed chunks, as it goes; its return value becomes the result. A falsy
+    result counts as a failure.
+    """
+
+    def __init__(self, session_id, name, label):
+        self.session_id = session_id
+        self.name = name
+        self.label = label
+        self.state = QUEUED
+        self.progress = 0.0
+        self._chunks = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self):
+        return self.state in (DONE, FAILED)
+
+    @property
+    def partial(self):
+        # Chunks are only joined when someone looks, not on every append.
+        return "".join(self._chunks) or None
+
+    def report(self, progress=None, partial=None):
+        if progress is not None:
+            self.progress = progress
+        if partial is not None:
+            self._chunks = [partial]
+
+    def append(self, chunk):
+        self._chunks.append(chunk)
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOBS_MAX_WORKERS, thread_name_prefix="job")
+        return _executor
+
+
+def submit(session_id, name, fn, label=None):
+    """Queue fn(job) unless the same job is already queued or running; returns the job either way."""
+    _sweep()
+    key = (session_id, name)
+    with _lock:
+        job = _jobs.get(key)
+        if job is not None and not job.finished:
+            return job
+        job = Job(session_id, name, label or name)
+        _jobs[key] = job
+    _get_executor().submit(_run, job, fn)
+    logger.debug(f"Queued job {name} for session {session_id[:8]}")
+    return job
+
+
+def _run(job, fn):
+    job.state = RUNNING
+    job.started_at = time.time()
+    try:
+        job.result = fn(job)
+        if not job.result:
+            job.error = "No result was returned"
+    except Exception as e:
+        logger.error(f"Job {job.name} failed: {str(e)}")
+        job.error = str(e)
+    job.finished_at = time.time()
+    job.progress = 1.0
+    job.state = DONE if job.error is None else FAILED
+    logger.info(
+        f"Job {job.name} {job.state} after {job.finished_at - job.started_at:.2f}s "
+        f"(queued {job.started_at - job.created_at:.2f}s)"
+    )
+
+
+def get(session_id, name):
+    with _lock:
+        return _jobs.get((session_id, name))
+
+
+def session_jobs(session_id):
+    with _lock:
+        return [job for (owner, _), job in _jobs.items() if owner == session_id]
+
+
+def discard(session_id, name):
+    with _lock:
+        job = _jobs.get((session_id, name))
+        if job is not None and job.finished:
+            del _jobs[(session_id, name)]
+
+
+def discard_session(session_id):
+    # Running jobs finish in the background; only their results are forgotten.
+    with _lock:
+        for key in [key for key in _jobs if key[0] == session_id]:
+            del _jobs[key]
+
+
+def _sweep():
+    cutoff = time.time() - JOBS_RETENTION_SECONDS
+    with _lock:
+        stale = [key for key, job in _jobs.items() if job.finished and job.finished_at < cutoff]
+        for key in stale:
+            del _jobs[key]
+    if stale:
+        logger.info(f"Dropped {len(stale)} uncollected finished job(s)")
@@ -1,14 +1,98 @@
+import atexit
+import copy
+import json
 import logging
+import multiprocessing
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
-def setup_logger():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.StreamHandler(),
-            logging.FileHandler("app.log")
-        ]
-    )
-    return logging.getLogger(__name__)
-
-logger = setup_logger()
\ No newline at end of file
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Per-module overrides, e.g. LOG_LEVELS="utils.scheduler=DEBUG,utils.clients=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FILE = os.getenv("LOG_FILE", "app.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+# Set to a TimedRotatingFileHandler interval such as "midnight" or "H" to rotate by time instead of size.
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+_configure_lock = threading.Lock()
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The stock prepare() bakes the traceback into the message; keep it in exc_text
+        # instead so the JSON formatter can emit it as its own field.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _file_handler():
+    if LOG_ROTATE_WHEN:
+        handler = TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    else:
+        handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+
+def _module_levels():
+    for entry in LOG_LEVELS.split(","):
+        name, _, level = entry.partition("=")
+        if name.strip() and level.strip():
+            yield name.strip(), level.strip().upper()
+
+
+def _configure():
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+        console = logging.StreamHandler()
+        console.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+        # Callers only pay for a queue put; formatting and file I/O happen on the listener thread.
+        log_queue = queue.SimpleQueue()
+        handlers = [console]
+        if multiprocessing.parent_process() is None:
+            # Worker processes (e.g. the PDF extraction pool) log to stderr only; several processes
+            # rotating one file would interleave and lose records.
+            handlers.append(_file_handler())
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+        root = logging.getLogger()
+        root.addHandler(_QueueHandler(log_queue))
+        root.setLevel(LOG_LEVEL.upper())
+        for name, level in _module_levels():
+            logging.getLogger(name).setLevel(level)
+
+
+def setup_logger(name=None):
+    _configure()
+    return logging.getLogger(name or __name__)
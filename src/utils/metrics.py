@@ -0,0 +1,162 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, start_http_server, write_to_textfile
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+METRICS_PORT = os.getenv("METRICS_PORT")
+# Loopback only by default; set e.g. METRICS_ADDR=0.0.0.0 for a scraper on another host.
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_FILE_INTERVAL = float(os.getenv("METRICS_FILE_INTERVAL", "15"))
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+REGISTRY = CollectorRegistry()
+CALLS = Counter(
+    "provider_calls_total", "Provider calls by outcome",
+    ["kind", "provider", "model", "outcome"], registry=REGISTRY
+)
+CALL_SECONDS = Histogram(
+    "provider_call_seconds", "Wall time of a process_image/process_text call",
+    ["kind", "provider", "model", "outcome"], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+STAGE_SECONDS = Histogram(
+    "provider_stage_seconds", "Wall time per stage (preprocess, upload, poll, generate, first_token, cleanup)",
+    ["kind", "provider", "model", "stage"], buckets=LATENCY_BUCKETS, registry=REGISTRY
+)
+TOKENS = Counter(
+    "provider_tokens_total", "Tokens reported by the provider (input, output, cached prefix reads and writes)",
+    ["kind", "provider", "model", "direction"], registry=REGISTRY
+)
+BYTES_SENT = Counter(
+    "provider_bytes_sent_total", "Payload bytes sent to the provider",
+    ["kind", "provider", "model"], registry=REGISTRY
+)
+
+_current_call = contextvars.ContextVar("current_call", default=None)
+_exporter_lock = threading.Lock()
+_exporters_started = False
+
+
+@contextmanager
+def track_call(kind, provider, model):
+    _start_exporters()
+    call = {"kind": kind, "provider": provider, "model": model, "outcome": None, "stages": {}, "tokens": {}}
+    token = _current_call.set(call)
+    started = time.perf_counter()
+    try:
+        yield call
+    except Exception:
+        call["outcome"] = "error"
+        raise
+    finally:
+        try:
+            _current_call.reset(token)
+        except ValueError:
+            # A streaming generator closed from another context; the variable dies with that context.
+            pass
+        elapsed = time.perf_counter() - started
+        outcome = call["outcome"] or "ok"
+        CALLS.labels(kind, provider, model, outcome).inc()
+        CALL_SECONDS.labels(kind, provider, model, outcome).observe(elapsed)
+        stages = " ".join(f"{name}={seconds:.3f}s" for name, seconds in call["stages"].items())
+        tokens = " ".join(f"{direction}_tokens={count}" for direction, count in call["tokens"].items())
+        logger.debug(f"{kind} call to {provider} ({model}) finished as {outcome} in {elapsed:.3f}s {stages} {tokens}")
+        if call["tokens"].get("cached"):
+            logger.info(f"{kind} call to {provider} ({model}) read {call['tokens']['cached']} prompt tokens from the provider cache")
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def record_stage(name, seconds):
+    call = _current_call.get()
+    if call is not None:
+        call["stages"][name] = call["stages"].get(name, 0.0) + seconds
+        STAGE_SECONDS.labels(call["kind"], call["provider"], call["model"], name).observe(seconds)
+
+
+def observe_stage(kind, provider, model, name, seconds):
+    # For work that happens outside any call, such as background file cleanup.
+    STAGE_SECONDS.labels(kind, provider, model, name).observe(seconds)
+
+
+def record_tokens(input_tokens=None, output_tokens=None, cached_tokens=None, cache_write_tokens=None):
+    call = _current_call.get()
+    if call is None:
+        return
+    counts = (("input", input_tokens), ("output", output_tokens), ("cached", cached_tokens), ("cache_write", cache_write_tokens))
+    for direction, count in counts:
+        if count:
+            TOKENS.labels(call["kind"], call["provider"], call["model"], direction).inc(count)
+            call["tokens"][direction] = call["tokens"].get(direction, 0) + count
+
+
+def _field(obj, name):
+    if obj is None:
+        return None
+    return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+
+def record_usage(usage):
+    # Accepts the usage object or dict of any provider SDK.
+    if usage is None:
+        return
+    get = lambda name: _field(usage, name)
+    record_tokens(
+        get("input_tokens") or get("prompt_tokens") or get("prompt_token_count"),
+        get("output_tokens") or get("completion_tokens") or get("candidates_token_count"),
+        # Prefix-cache reads: Claude, OpenAI and Gemini report them under different names.
+        get("cache_read_input_tokens") or _field(get("prompt_tokens_details"), "cached_tokens")
+        or get("cached_content_token_count"),
+        get("cache_creation_input_tokens"),
+    )
+
+
+def record_bytes(count):
+    call = _current_call.get()
+    if call is not None and count:
+        BYTES_SENT.labels(call["kind"], call["provider"], call["model"]).inc(count)
+
+
+def render():
+    return generate_latest(REGISTRY).decode("utf-8")
+
+
+def _start_exporters():
+    global _exporters_started
+    if _exporters_started:
+        return
+    with _exporter_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+        if METRICS_PORT:
+            try:
+                start_http_server(int(METRICS_PORT), addr=METRICS_ADDR, registry=REGISTRY)
+                logger.info(f"Serving Prometheus metrics on {METRICS_ADDR}:{METRICS_PORT}")
+            except OSError as e:
+                # Another process (e.g. a second Streamlit worker) may already own the port.
+                logger.warning(f"Could not start metrics endpoint on port {METRICS_PORT}: {str(e)}")
+        if METRICS_FILE:
+            threading.Thread(target=_write_metrics_file, name="metrics-file", daemon=True).start()
+
+
+def _write_metrics_file():
+    while True:
+        time.sleep(METRICS_FILE_INTERVAL)
+        try:
+            write_to_textfile(METRICS_FILE, REGISTRY)
+        except OSError as e:
+            logger.warning(f"Could not write metrics file {METRICS_FILE}: {str(e)}")
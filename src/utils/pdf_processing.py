@@ -0,0 +1,133 @@
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from PyPDF2 import PdfReader
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Extracted text is shared by every session in the process, keyed by the PDF's content hash.
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(min(8, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+# Below this many pages the process pool's overhead outweighs the parallelism.
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "24"))
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+_executor = None
+# In a worker process: (digest, reader) of the PDF its last task came from, reused by later tasks on it.
+_worker_reader = (None, None)
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawn rather than fork: the Streamlit server process is multi-threaded.
+            _executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def _extract_range(path, digest, start, stop):
+    global _worker_reader
+    if _worker_reader[0] != digest:
+        _worker_reader = (digest, PdfReader(path))
+    reader = _worker_reader[1]
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def cached_text(data):
+    return _cached(_digest(data))
+
+
+def _cached(digest):
+    with _lock:
+        text = _cache.get(digest)
+        if text is not None:
+            _cache.move_to_end(digest)
+        return text
+
+
+def _store(digest, text):
+    global _cache_bytes
+    size = len(text.encode("utf-8"))
+    if size > PDF_CACHE_MAX_BYTES:
+        return
+    with _lock:
+        if digest in _cache:
+            return
+        _cache[digest] = text
+        _cache_bytes += size
+        while _cache_bytes > PDF_CACHE_MAX_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted.encode("utf-8"))
+
+
+def iter_pdf_pages(data):
+    """Yield (page_index, page_count, text) in page order as soon as each page is extracted."""
+    page_count = len(PdfReader(BytesIO(data)).pages)
+    if page_count < PDF_PARALLEL_MIN_PAGES or PDF_WORKERS <= 1:
+        reader = PdfReader(BytesIO(data))
+        for index, page in enumerate(reader.pages):
+            yield index, page_count, page.extract_text() or ""
+        return
+
+    ranges = [(start, min(start + PDF_PAGES_PER_TASK, page_count)) for start in range(0, page_count, PDF_PAGES_PER_TASK)]
+    executor = _get_executor()
+    # Workers read the PDF from a temporary file, so tasks carry only their page range instead of
+    # a pickled copy of the whole document each.
+    digest = _digest(data)
+    fd, path = tempfile.mkstemp(prefix="pdf-extract-", suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    # Only a window of tasks is in flight, so pages are yielded in order without queueing the whole PDF.
+    window = PDF_WORKERS * 2
+    pending = deque()
+    try:
+        for start, stop in ranges:
+            pending.append((start, executor.submit(_extract_range, path, digest, start, stop)))
+            if len(pending) >= window:
+                yield from _drain(pending.popleft(), page_count)
+        while pending:
+            yield from _drain(pending.popleft(), page_count)
+    finally:
+        for _, future in pending:
+            future.cancel()
+        # A task that has not opened the file yet fails, but by then nobody wants its pages.
+        os.remove(path)
+
+
+def _drain(task, page_count):
+    start, future = task
+    for offset, text in enumerate(future.result()):
+        yield start + offset, page_count, text
+
+
+def extract_pdf_text(data, on_progress=None):
+    digest = _digest(data)
+    text = _cached(digest)
+    if text is not None:
+        return text
+
+    started = time.perf_counter()
+    pages = []
+    for index, page_count, page_text in iter_pdf_pages(data):
+        pages.append(page_text)
+        if on_progress is not None:
+            on_progress(index + 1, page_count)
+    text = "\n".join(pages)
+    _store(digest, text)
+    logger.info(f"Extracted {len(pages)} PDF pages ({len(text)} chars) in {time.perf_counter() - started:.2f}s")
+    return text
@@ -0,0 +1,156 @@
+import datetime
+import hashlib
+import os
+import threading
+import time
+from utils import metrics, sdk
+from utils.logger import setup_logger
+from utils.retrieval import retrieval_share
+from utils.scheduler import call_with_retry, status_code
+from utils.tokens import count_tokens
+
+logger = setup_logger(__name__)
+
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "1") == "1"
+# Documents that retrieval would send most of anyway are pinned whole at the head of the conversation.
+# Cacheable documents up to this size are pinned too, so the provider caches them instead of each turn
+# carrying retrieved chunks; larger ones are answered from retrieval (0 leaves only the first rule).
+PROMPT_CACHE_MAX_DOCUMENT_TOKENS = int(os.getenv("PROMPT_CACHE_MAX_DOCUMENT_TOKENS", "65536"))
+# Share of a document a retrieved context must carry for retrieval to count as sending most of it.
+PIN_RETRIEVAL_SHARE = 0.5
+GEMINI_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CACHE_TTL_SECONDS", "3600"))
+EXPIRY_MARGIN_SECONDS = 120
+
+# Smallest prefix each provider will cache. OpenAI caches prompts of this size automatically,
+# Claude needs cache_control breakpoints and Gemini an explicitly created cached content.
+MIN_CACHE_TOKENS = {"Gemini": 32768, "Claude": 1024, "OpenAI": 1024}
+# Gemini only caches contents for explicitly versioned models.
+GEMINI_CACHE_MODELS = {
+    "gemini-1.5-flash": "gemini-1.5-flash-001",
+    "gemini-1.5-pro": "gemini-1.5-pro-001",
+}
+# Responses meaning the model cannot cache contents at all, as opposed to this attempt having failed.
+CACHE_UNSUPPORTED_STATUS_CODES = {400, 404}
+ANTHROPIC_CACHE_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+DOCUMENT_TURN_TEXT = "This is the document we will be discussing."
+DOCUMENT_ACK_TEXT = "I have read the document and will refer to it in my answers."
+# Creations for different documents share one of this many locks, so the lock table never grows.
+CREATE_LOCK_STRIPES = 64
+
+_caches = {}
+_create_locks = [threading.Lock() for _ in range(CREATE_LOCK_STRIPES)]
+_unsupported = set()
+_lock = threading.Lock()
+
+
+def reaches_cache_minimum(api_choice, text):
+    """Whether text alone is long enough to be cached as a prefix by the provider."""
+    return api_choice in MIN_CACHE_TOKENS and count_tokens(text, api_choice) >= MIN_CACHE_TOKENS[api_choice]
+
+
+def caches_document(api_choice, model, text):
+    """Whether text can be cached by the provider when pinned at the head of the conversation."""
+    return bool(text) and _can_cache(api_choice, model) and reaches_cache_minimum(api_choice, text)
+
+
+def pins_document(api_choice, model, text):
+    """Whether text should be pinned whole at the head of the conversation rather than retrieved per question."""
+    if not text:
+        return False
+    if retrieval_share(text) >= PIN_RETRIEVAL_SHARE:
+        # Retrieval would send (nearly) all of it with every question; a stable head costs no more and can be cached.
+        return True
+    if not _can_cache(api_choice, model):
+        return False
+    tokens = count_tokens(text, api_choice)
+    return MIN_CACHE_TOKENS[api_choice] <= tokens <= PROMPT_CACHE_MAX_DOCUMENT_TOKENS
+
+
+def _can_cache(api_choice, model):
+    if not PROMPT_CACHE_ENABLED or api_choice not in MIN_CACHE_TOKENS:
+        return False
+    return not (api_choice == "Gemini" and GEMINI_CACHE_MODELS.get(model, model) in _unsupported)
+
+
+def claude_request_options():
+    return {"extra_headers": ANTHROPIC_CACHE_HEADERS} if PROMPT_CACHE_ENABLED else {}
+
+
+def claude_breakpoint(block):
+    """Mark a Claude content block as the end of a cacheable prefix."""
+    if PROMPT_CACHE_ENABLED:
+        block = dict(block, cache_control={"type": "ephemeral"})
+    return block
+
+
+def _digest(model, text):
+    digest = hashlib.sha256(text.encode("utf-8"))
+    # Cached contents belong to the API key and model that created them.
+    digest.update(f"\0{model}\0{os.getenv('GEMINI_API_KEY') or ''}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def gemini_cached_content(model, text):
+    """Return a live Gemini CachedContent holding text as a pinned document turn, or None if it cannot be cached."""
+    cache_model = GEMINI_CACHE_MODELS.get(model, model)
+    digest = _digest(cache_model, text)
+    cached = _cached(digest)
+    if cached is not None:
+        return cached
+
+    # Only one cached content per distinct document, even when several sessions ask for it at once.
+    with _create_locks[int(digest[:8], 16) % CREATE_LOCK_STRIPES]:
+        cached = _cached(digest)
+        if cached is not None:
+            return cached
+        started = time.perf_counter()
+        try:
+            caching = sdk.load("Gemini").caching
+            with metrics.stage("cache_create"):
+                cached = call_with_retry(
+                    "Gemini", "caching",
+                    # CachedContent.create takes no timeout; the deadline still stops further attempts.
+                    lambda timeout: caching.CachedContent.create(
+                        model=f"models/{cache_model}",
+                        display_name=f"document-{digest[:12]}",
+                        contents=[
+                            {"role": "user", "parts": [text, DOCUMENT_TURN_TEXT]},
+                            {"role": "model", "parts": [DOCUMENT_ACK_TEXT]},
+                        ],
+                        ttl=datetime.timedelta(seconds=GEMINI_CACHE_TTL_SECONDS),
+                    )
+                )
+        except Exception as e:
+            logger.warning(f"Could not create a Gemini cached content for {cache_model}, sending the document uncached: {str(e)}")
+            if _caching_unsupported(e):
+                # Transient failures (rate limits, timeouts, 5xx) only cost this turn its cache.
+                with _lock:
+                    _unsupported.add(cache_model)
+                logger.info(f"Gemini context caching disabled for {cache_model}")
+            return None
+        elapsed = time.perf_counter() - started
+        expiration = getattr(cached, "expire_time", None)
+        expires_at = expiration.timestamp() if expiration else time.time() + GEMINI_CACHE_TTL_SECONDS
+        with _lock:
+            _caches[digest] = {"cached": cached, "expires_at": expires_at}
+        logger.info(f"Created Gemini cached content {cached.name} for {len(text)} chars in {elapsed:.2f}s")
+        return cached
+
+
+def _caching_unsupported(error):
+    status = status_code(error)
+    if status is not None:
+        return status in CACHE_UNSUPPORTED_STATUS_CODES
+    return "not supported" in str(error).lower()
+
+
+def _cached(digest):
+    with _lock:
+        entry = _caches.get(digest)
+        if entry is None:
+            return None
+        if entry["expires_at"] - EXPIRY_MARGIN_SECONDS <= time.time():
+            # Gemini deletes it at expiry; a fresh one is created on the next request.
+            del _caches[digest]
+            return None
+        return entry["cached"]
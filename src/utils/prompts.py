@@ -0,0 +1,37 @@
+FINAL_CONTENT_PROMPT = """
+    Based on the provided information, generate a final, cohesive social media post that incorporates:
+    1. Key insights from the image analysis
+    2. The user's caption
+    3. The provided hashtags
+    
+    The post should be:
+    - Engaging and relevant to the image content
+    - Optimized for social media engagement
+    - Formatted appropriately for the platform (assume it's for Instagram)
+    - No longer than 2200 characters (Instagram's caption limit)
+    
+    Structure the response as follows:
+    1. Final Caption (including emojis if appropriate)
+    2. Hashtags (list the most relevant hashtags, max 30)
+    3. Brief explanation of how the final content incorporates the original analysis and user input
+    """
+
+def build_final_content_input(analysis, caption, hashtags):
+    return f"""
+    Original image analysis: {analysis}
+    
+    User's caption: {caption}
+    
+    User's hashtags: {hashtags}
+    """
+
+MULTI_IMAGE_PROMPT = """
+    You are given {count} images, labelled Image 1 to Image {count} in the order they appear.
+    Follow the instructions below for each image separately; do not compare or merge the images.
+
+    Instructions:
+    {prompt}
+
+    Reply with JSON only, one entry per image in order, in exactly this shape:
+    {{"analyses": [{{"image": 1, "analysis": "..."}}, {{"image": 2, "analysis": "..."}}]}}
+    """
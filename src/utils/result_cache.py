@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+CACHE_PATH = os.getenv("RESULT_CACHE_PATH", str(Path(__file__).parent.parent.parent / ".cache" / "results.sqlite3"))
+CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_lock = threading.Lock()
+_conn = None
+_stats = {"hits": 0, "misses": 0}
+
+
+def _connection():
+    global _conn
+    if _conn is None:
+        Path(CACHE_PATH).parent.mkdir(parents=True, exist_ok=True)
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False, isolation_level=None)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        _conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+    return _conn
+
+
+def make_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else repr(part).encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def get(key):
+    now = time.time()
+    try:
+        with _lock:
+            conn = _connection()
+            row = conn.execute("SELECT value, created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > CACHE_TTL_SECONDS:
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                _stats["misses"] += 1
+                return None
+            conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            _stats["hits"] += 1
+            return row[0]
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Result cache lookup failed: {str(e)}")
+        return None
+
+
+def put(key, value):
+    now = time.time()
+    size = len(value.encode("utf-8"))
+    try:
+        with _lock:
+            conn = _connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, value, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            _evict(conn, now)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Result cache write failed: {str(e)}")
+
+
+def _evict(conn, now):
+    conn.execute("DELETE FROM results WHERE created_at < ?", (now - CACHE_TTL_SECONDS,))
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+    if total <= CACHE_MAX_BYTES:
+        return
+    evicted = 0
+    for key, size in conn.execute("SELECT key, size FROM results ORDER BY last_access").fetchall():
+        if total <= CACHE_MAX_BYTES:
+            break
+        conn.execute("DELETE FROM results WHERE key = ?", (key,))
+        total -= size
+        evicted += 1
+    logger.info(f"Evicted {evicted} least recently used result cache entries")
+
+
+def clear():
+    """Delete every cached result; returns False if the cache could not be opened."""
+    try:
+        with _lock:
+            _connection().execute("DELETE FROM results")
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Result cache clear failed: {str(e)}")
+        return False
+    logger.info("Cleared the result cache")
+    return True
+
+
+def stats():
+    with _lock:
+        try:
+            entries, total = _connection().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        except (OSError, sqlite3.Error):
+            # An unusable cache directory just means nothing is cached.
+            entries, total = 0, 0
+        return {"hits": _stats["hits"], "misses": _stats["misses"], "entries": entries, "bytes": total}
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+import numpy as np
+
+RETRIEVAL_CHUNK_WORDS = int(os.getenv("RETRIEVAL_CHUNK_WORDS", "200"))
+RETRIEVAL_CHUNK_OVERLAP = int(os.getenv("RETRIEVAL_CHUNK_OVERLAP", "40"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "5"))
+# Documents shorter than this are sent whole; retrieval only pays off on long ones.
+RETRIEVAL_MIN_CHARS = int(os.getenv("RETRIEVAL_MIN_CHARS", "12000"))
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "16"))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def tokenize(text):
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+def chunk_text(text, chunk_words=RETRIEVAL_CHUNK_WORDS, overlap=RETRIEVAL_CHUNK_OVERLAP):
+    words = text.split()
+    step = max(1, chunk_words - overlap)
+    return [" ".join(words[start:start + chunk_words]) for start in range(0, max(len(words) - overlap, 1), step)]
+
+
+class BM25Index:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.vocabulary = {}
+        postings = {}
+        lengths = np.zeros(len(chunks), dtype=np.float32)
+        for doc_id, chunk in enumerate(chunks):
+            terms = Counter(tokenize(chunk))
+            lengths[doc_id] = sum(terms.values())
+            for term, tf in terms.items():
+                term_id = self.vocabulary.setdefault(term, len(self.vocabulary))
+                postings.setdefault(term_id, []).append((doc_id, tf))
+
+        # Inverted index in CSR layout: postings of term t are doc_ids/tfs[offsets[t]:offsets[t + 1]].
+        counts = np.array([len(postings[t]) for t in range(len(self.vocabulary))], dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        flat = [posting for t in range(len(self.vocabulary)) for posting in postings[t]]
+        self.doc_ids = np.array([doc_id for doc_id, _ in flat], dtype=np.int32)
+        tfs = np.array([tf for _, tf in flat], dtype=np.float32)
+
+        n = len(chunks)
+        self.idf = np.log1p((n - counts + 0.5) / (counts + 0.5)).astype(np.float32)
+        # Term weights are fixed once the index is built, so BM25's tf saturation is precomputed.
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(lengths.mean(), 1.0))
+        self.weights = tfs * (BM25_K1 + 1) / (tfs + norm[self.doc_ids])
+
+    def search(self, query, k=RETRIEVAL_TOP_K):
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, stop = self.offsets[term_id], self.offsets[term_id + 1]
+            scores[self.doc_ids[start:stop]] += self.idf[term_id] * self.weights[start:stop]
+        k = min(k, len(self.chunks))
+        top = np.argpartition(-scores, k - 1)[:k] if k else np.array([], dtype=np.int64)
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > 0]
+
+
+def get_index(text):
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    with _lock:
+        index = _indexes.get(digest)
+        if index is not None:
+            _indexes.move_to_end(digest)
+            return index
+    index = BM25Index(chunk_text(text))
+    with _lock:
+        _indexes[digest] = index
+        while len(_indexes) > RETRIEVAL_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
+
+
+def retrieve(text, query, k=RETRIEVAL_TOP_K):
+    """Return [(chunk_index, score, chunk)] for the k chunks of text most relevant to query, in document order."""
+    index = get_index(text)
+    hits = index.search(query, k)
+    return sorted((i, score, index.chunks[i]) for i, score in hits)
+
+
+def retrieval_share(text, k=RETRIEVAL_TOP_K):
+    """Return the largest fraction of text a context from build_context can carry (1.0 when it is sent whole)."""
+    if len(text) <= RETRIEVAL_MIN_CHARS:
+        return 1.0
+    # Chunks overlap, so k of them never cover more than k * RETRIEVAL_CHUNK_WORDS distinct words.
+    return min(1.0, k * RETRIEVAL_CHUNK_WORDS / max(len(text.split()), 1))
+
+
+def build_context(text, query, k=RETRIEVAL_TOP_K):
+    """Return (context, hits): the whole text if it is short, otherwise only its most relevant chunks."""
+    if len(text) <= RETRIEVAL_MIN_CHARS:
+        return text, []
+    hits = retrieve(text, query, k)
+    if not hits:
+        # Nothing in the query matched; the opening of a document usually says what it is about.
+        hits = [(i, 0.0, chunk) for i, chunk in enumerate(get_index(text).chunks[:k])]
+    return "\n\n[...]\n\n".join(chunk for _, _, chunk in hits), hits
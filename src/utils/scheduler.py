@@ -0,0 +1,211 @@
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Requests and tokens per minute for each provider; override with RATE_LIMIT_<PROVIDER>_RPM/_TPM
+# or per model with RATE_LIMIT_OVERRIDES='{"gemini-1.5-pro": {"rpm": 360, "tpm": 4000000}}'.
+DEFAULT_RATE_LIMITS = {
+    "Gemini": {"rpm": 1000, "tpm": 4_000_000},
+    "OpenAI": {"rpm": 500, "tpm": 800_000},
+    "Claude": {"rpm": 50, "tpm": 80_000},
+    "Meta-Llama": {"rpm": 600, "tpm": 1_000_000},
+}
+RATE_LIMIT_OVERRIDES = json.loads(os.getenv("RATE_LIMIT_OVERRIDES", "{}"))
+
+MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", "5"))
+BACKOFF_BASE_SECONDS = float(os.getenv("PROVIDER_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX_SECONDS = float(os.getenv("PROVIDER_BACKOFF_MAX", "30"))
+CALL_DEADLINE_SECONDS = float(os.getenv("PROVIDER_CALL_DEADLINE_SECONDS", "180"))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+# Transport-level failures, matched by class name so no provider SDK has to be imported here.
+RETRYABLE_ERROR_NAMES = {
+    "APIConnectionError", "APITimeoutError", "ConnectionError", "ConnectTimeout", "ReadTimeout",
+    "Timeout", "TimeoutException", "TransportError", "ServiceUnavailable", "DeadlineExceeded",
+    "ResourceExhausted", "InternalServerError", "TooManyRequests",
+}
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount, deadline):
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            if now + wait > deadline:
+                raise DeadlineExceeded("Rate limit wait would exceed the call deadline")
+            time.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def _limits(provider, model):
+    limits = dict(DEFAULT_RATE_LIMITS.get(provider, {"rpm": 60, "tpm": 100_000}))
+    prefix = f"RATE_LIMIT_{provider.upper().replace('-', '_')}"
+    for name in ("rpm", "tpm"):
+        value = os.getenv(f"{prefix}_{name.upper()}")
+        if value:
+            limits[name] = int(value)
+    limits.update(RATE_LIMIT_OVERRIDES.get(model, {}))
+    return limits
+
+
+def _get_buckets(provider, model):
+    key = (provider, model)
+    with _buckets_lock:
+        if key not in _buckets:
+            limits = _limits(provider, model)
+            _buckets[key] = (TokenBucket(limits["rpm"]), TokenBucket(limits["tpm"]))
+        return _buckets[key]
+
+
+def estimate_tokens(*texts, max_tokens=None):
+    # Roughly four characters per token; output tokens count against the per-minute budget too.
+    return sum(len(text) for text in texts if text) // 4 + (max_tokens or 0)
+
+
+def status_code(error):
+    for candidate in (error, getattr(error, "response", None)):
+        for attr in ("status_code", "http_status"):
+            value = getattr(candidate, attr, None)
+            if isinstance(value, int):
+                return value
+    code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(error):
+    if isinstance(error, DeadlineExceeded):
+        return False
+    status = status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def _backoff(attempt, error):
+    delay = retry_after(error)
+    if delay is None:
+        # Full jitter keeps concurrent callers from retrying in lockstep.
+        delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    return delay
+
+
+def _deadline(deadline):
+    return deadline if deadline is not None else time.monotonic() + CALL_DEADLINE_SECONDS
+
+
+def _attempt_timeout(provider, model, deadline):
+    # Each attempt only gets what is left of the deadline, so one slow attempt cannot outlast it.
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded(f"{provider} call for {model} reached its deadline before the next attempt")
+    return remaining
+
+
+def call_with_retry(provider, model, fn, estimated_tokens=0, deadline=None):
+    """Call fn(timeout) under the provider's rate limits, retrying transient failures until the deadline.
+
+    timeout is the number of seconds left before the deadline; fn passes it on as the request timeout.
+    """
+    deadline = _deadline(deadline)
+    request_bucket, token_bucket = _get_buckets(provider, model)
+    attempt = 0
+    while True:
+        request_bucket.acquire(1, deadline)
+        token_bucket.acquire(estimated_tokens, deadline)
+        timeout = _attempt_timeout(provider, model, deadline)
+        try:
+            return fn(timeout)
+        except Exception as e:
+            delay = _retry_delay(provider, model, attempt, e, deadline)
+            time.sleep(delay)
+            attempt += 1
+
+
+class StreamInterrupted(Exception):
+    """A stream failed after some of its output was already handed to the caller."""
+
+
+def stream_with_retry(provider, model, fn, estimated_tokens=0, deadline=None):
+    # Retries are only safe until the first chunk has been handed to the caller; after that the
+    # partial output must not pass for a complete response.
+    deadline = _deadline(deadline)
+    request_bucket, token_bucket = _get_buckets(provider, model)
+    attempt = 0
+    while True:
+        request_bucket.acquire(1, deadline)
+        token_bucket.acquire(estimated_tokens, deadline)
+        timeout = _attempt_timeout(provider, model, deadline)
+        started = False
+        try:
+            for chunk in fn(timeout):
+                started = True
+                yield chunk
+            return
+        except Exception as e:
+            if started:
+                raise StreamInterrupted(f"{provider} stream for {model} failed part-way: {str(e)}") from e
+            delay = _retry_delay(provider, model, attempt, e, deadline)
+            time.sleep(delay)
+            attempt += 1
+
+
+def _retry_delay(provider, model, attempt, error, deadline):
+    if attempt >= MAX_RETRIES or not is_retryable(error):
+        raise error
+    delay = _backoff(attempt, error)
+    if time.monotonic() + delay > deadline:
+        raise error
+    logger.warning(
+        f"{provider} call for {model} failed with {type(error).__name__} (status {status_code(error)}), "
+        f"retry {attempt + 1}/{MAX_RETRIES} in {delay:.2f}s"
+    )
+    return delay
@@ -0,0 +1,54 @@
+import importlib
+import os
+import threading
+import time
+from utils import metrics
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def _configure_gemini(module):
+    # Configured on load so Gemini is usable as soon as anything, including a fallback, asks for it.
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        return
+    endpoint = os.getenv("GEMINI_API_ENDPOINT")
+    if endpoint:
+        # Only the REST transport accepts a plain http:// endpoint such as a local mock server.
+        module.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": endpoint})
+    else:
+        module.configure(api_key=api_key)
+
+
+# Provider SDKs are heavy (google.generativeai alone takes over a second to import), so each one
+# is imported the first time its api_choice is used rather than when a page loads.
+SDK_REGISTRY = {
+    "Gemini": ("google.generativeai", _configure_gemini),
+    "OpenAI": ("openai", None),
+    "Claude": ("anthropic", None),
+    "Meta-Llama": ("together", None),
+}
+
+_modules = {}
+_lock = threading.Lock()
+
+
+def load(api_choice):
+    module = _modules.get(api_choice)
+    if module is not None:
+        return module
+    with _lock:
+        module = _modules.get(api_choice)
+        if module is None:
+            module_name, configure = SDK_REGISTRY[api_choice]
+            started = time.perf_counter()
+            module = importlib.import_module(module_name)
+            if configure is not None:
+                configure(module)
+            elapsed = time.perf_counter() - started
+            metrics.observe_stage("startup", api_choice, module_name, "import", elapsed)
+            logger.info(f"Loaded {api_choice} SDK ({module_name}) in {elapsed:.2f}s")
+            _modules[api_choice] = module
+    return module
+
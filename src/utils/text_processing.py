@@ -1,119 +1,335 @@
 import os
-import google.generativeai as genai
-import anthropic
-from openai import OpenAI
-from together import Together
+import time
+from utils import cassettes, metrics, result_cache, sdk
+from utils.clients import get_anthropic_client, get_openai_client, get_together_client
 from utils.logger import setup_logger
+from utils.hedging import TEXT_CANDIDATES, build_candidates, call_with_fallback, record_outcome
+from utils.scheduler import StreamInterrupted, call_with_retry, estimate_tokens, stream_with_retry
 
-logger = setup_logger()
+logger = setup_logger(__name__)
 
-def process_text(content, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None):
+TEXT_PROVIDERS = ("Gemini", "OpenAI", "Claude", "Meta-Llama")
+
+def process_text(content, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None, use_cache=True):
+    with metrics.track_call("text", api_choice, model) as call:
+        cache_key = None
+        if use_cache:
+            cache_key = result_cache.make_key("text", content, prompt, api_choice, model, temperature, top_p, max_tokens)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Result cache hit for text processing. API: {api_choice}, Model: {model}")
+                call["outcome"] = "cache_hit"
+                return cached
+
+        started = time.perf_counter()
+        if api_choice not in TEXT_PROVIDERS:
+            logger.error(f"Unsupported API choice: {api_choice}")
+            call["outcome"] = "error"
+            return None
+        metrics.record_bytes(_payload_bytes(content, prompt))
+        result = cassettes.call(
+            "text", api_choice, model, _cassette_request(content, prompt, temperature, top_p, max_tokens),
+            lambda: _generate(content, prompt, api_choice, model, temperature, top_p, max_tokens)
+        )
+        record_outcome(api_choice, model, time.perf_counter() - started, bool(result))
+        call["outcome"] = "ok" if result else "error"
+
+        if cache_key and result:
+            result_cache.put(cache_key, result)
+        return result
+
+def process_text_with_fallback(content, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None, use_cache=True, mode="hedge"):
+    # mode is "hedge" (race a second provider after a latency-percentile delay) or "failover".
+    candidates = build_candidates(api_choice, model, TEXT_CANDIDATES)
+    return call_with_fallback(
+        candidates,
+        lambda api, candidate_model: process_text(
+            content, prompt, api, candidate_model, temperature, top_p, max_tokens, use_cache
+        ),
+        mode
+    )
+
+def stream_text(content, prompt, api_choice, model, temperature=None, top_p=None, max_tokens=None, use_cache=True):
+    with metrics.track_call("text", api_choice, model) as call:
+        cache_key = None
+        if use_cache:
+            cache_key = result_cache.make_key("text", content, prompt, api_choice, model, temperature, top_p, max_tokens)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Result cache hit for text processing. API: {api_choice}, Model: {model}")
+                call["outcome"] = "cache_hit"
+                yield cached
+                return
+
+        started = time.perf_counter()
+        if api_choice not in TEXT_PROVIDERS:
+            logger.error(f"Unsupported API choice: {api_choice}")
+            call["outcome"] = "error"
+            return
+        metrics.record_bytes(_payload_bytes(content, prompt))
+        chunks = cassettes.stream(
+            "text", api_choice, model, _cassette_request(content, prompt, temperature, top_p, max_tokens),
+            lambda: _stream(content, prompt, api_choice, model, temperature, top_p, max_tokens)
+        )
+
+        parts = []
+        try:
+            for chunk in chunks:
+                if not parts:
+                    metrics.record_stage("first_token", time.perf_counter() - started)
+                parts.append(chunk)
+                yield chunk
+        except StreamInterrupted:
+            # The partial text is neither cached nor indexed; the caller sees the failure.
+            record_outcome(api_choice, model, time.perf_counter() - started, False)
+            raise
+        record_outcome(api_choice, model, time.perf_counter() - started, bool(parts))
+        call["outcome"] = "ok" if parts else "error"
+        if cache_key and parts:
+            result_cache.put(cache_key, "".join(parts))
+
+def _generate(content, prompt, api_choice, model, temperature, top_p, max_tokens):
     if api_choice == "Gemini":
         return process_text_gemini(content, prompt, model, temperature, top_p, max_tokens)
-    elif api_choice == "OpenAI":
+    if api_choice == "OpenAI":
         return process_text_openai(content, prompt, model, temperature, max_tokens)
-    elif api_choice == "Claude":
+    if api_choice == "Claude":
         return process_text_claude(content, prompt, model, max_tokens)
-    elif api_choice == "Meta-Llama":
-        return process_text_meta_llama(content, prompt, model, temperature, top_p, max_tokens)
-    else:
-        logger.error(f"Unsupported API choice: {api_choice}")
-        return None
+    return process_text_meta_llama(content, prompt, model, temperature, top_p, max_tokens)
+
+def _stream(content, prompt, api_choice, model, temperature, top_p, max_tokens):
+    if api_choice == "Gemini":
+        return stream_text_gemini(content, prompt, model, temperature, top_p, max_tokens)
+    if api_choice == "OpenAI":
+        return stream_text_openai(content, prompt, model, temperature, max_tokens)
+    if api_choice == "Claude":
+        return stream_text_claude(content, prompt, model, max_tokens)
+    return stream_text_meta_llama(content, prompt, model, temperature, top_p, max_tokens)
+
+def _cassette_request(content, prompt, temperature, top_p, max_tokens):
+    # Content can be a whole PDF, so only its digest is stored.
+    return {
+        "content": cassettes.digest(content),
+        "chars": len(content or ""),
+        "prompt": prompt,
+        "temperature": temperature,
+        "top_p": top_p,
+        "max_tokens": max_tokens,
+    }
+
+def _full_prompt(content, prompt):
+    return "\n\n".join(part for part in (content, prompt) if part)
+
+def _payload_bytes(content, prompt):
+    return len((content or "").encode("utf-8")) + len((prompt or "").encode("utf-8"))
 
 def process_text_meta_llama(content, prompt, model, temperature, top_p, max_tokens):
     try:
         logger.info(f"Starting text processing with Meta-Llama. Model: {model}, Temperature: {temperature}, Top P: {top_p}, Max Tokens: {max_tokens}")
-        client = Together(api_key=os.getenv('TOGETHER_API_KEY'))
-        full_prompt = f"{content}\n\n{prompt}"
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": full_prompt}],
-            max_tokens=max_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            top_k=50,
-            repetition_penalty=1,
-            stop=["<|eot_id|>"],
-            stream=False
-        )
-        
+        with metrics.stage("generate"):
+            response = call_with_retry(
+                "Meta-Llama", model,
+                lambda timeout: _meta_llama_completion(content, prompt, model, temperature, top_p, max_tokens, stream=False),
+                estimate_tokens(content, prompt, max_tokens=max_tokens)
+            )
+        metrics.record_usage(getattr(response, "usage", None))
         logger.info("Content generated successfully by Meta-Llama model")
         return response.choices[0].message.content if response.choices else None
     except Exception as e:
         logger.error(f"An error occurred while processing the text with Meta-Llama: {str(e)}")
         return None
 
+def stream_text_meta_llama(content, prompt, model, temperature, top_p, max_tokens):
+    try:
+        logger.info(f"Starting streamed text processing with Meta-Llama. Model: {model}, Temperature: {temperature}, Top P: {top_p}, Max Tokens: {max_tokens}")
+        def generate(timeout):
+            for chunk in _meta_llama_completion(content, prompt, model, temperature, top_p, max_tokens, stream=True):
+                if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                metrics.record_usage(getattr(chunk, "usage", None))
+
+        with metrics.stage("generate"):
+            yield from stream_with_retry("Meta-Llama", model, generate, estimate_tokens(content, prompt, max_tokens=max_tokens))
+        logger.info("Content streamed successfully by Meta-Llama model")
+    except StreamInterrupted as e:
+        logger.error(f"Stream interrupted, discarding the partial response: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred while streaming the text from Meta-Llama: {str(e)}")
+
+def _meta_llama_completion(content, prompt, model, temperature, top_p, max_tokens, stream):
+    # The Together SDK has no per-request timeout; its calls are bounded by the client's CLIENT_TIMEOUT.
+    client = get_together_client(os.getenv('TOGETHER_API_KEY'))
+    full_prompt = _full_prompt(content, prompt)
+    return client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": full_prompt}],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        top_k=50,
+        repetition_penalty=1,
+        stop=["<|eot_id|>"],
+        stream=stream
+    )
+
 def process_text_gemini(content, prompt, model, temperature, top_p, max_tokens):
     try:
         logger.info(f"Starting text processing with Gemini. Model: {model}, Temperature: {temperature}, Top P: {top_p}, Max Tokens: {max_tokens}")
-        gemini_model = genai.GenerativeModel(model_name=model)
-        full_prompt = f"{content}\n\n{prompt}"
-        response = gemini_model.generate_content(
-            full_prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=temperature,
-                top_p=top_p,
-                max_output_tokens=max_tokens,
+        with metrics.stage("generate"):
+            response = call_with_retry(
+                "Gemini", model,
+                lambda timeout: _gemini_generate(content, prompt, model, temperature, top_p, max_tokens, stream=False, timeout=timeout),
+                estimate_tokens(content, prompt, max_tokens=max_tokens)
             )
-        )
+        metrics.record_usage(getattr(response, "usage_metadata", None))
         logger.info("Content generated successfully by Gemini model")
         return response.text if response and response.parts else None
     except Exception as e:
         logger.error(f"An error occurred while processing the text with Gemini: {str(e)}")
         return None
 
+def stream_text_gemini(content, prompt, model, temperature, top_p, max_tokens):
+    try:
+        logger.info(f"Starting streamed text processing with Gemini. Model: {model}, Temperature: {temperature}, Top P: {top_p}, Max Tokens: {max_tokens}")
+        def generate(timeout):
+            chunk = None
+            for chunk in _gemini_generate(content, prompt, model, temperature, top_p, max_tokens, stream=True, timeout=timeout):
+                if chunk.parts:
+                    yield chunk.text
+            metrics.record_usage(getattr(chunk, "usage_metadata", None))
+
+        with metrics.stage("generate"):
+            yield from stream_with_retry("Gemini", model, generate, estimate_tokens(content, prompt, max_tokens=max_tokens))
+        logger.info("Content streamed successfully by Gemini model")
+    except StreamInterrupted as e:
+        logger.error(f"Stream interrupted, discarding the partial response: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred while streaming the text from Gemini: {str(e)}")
+
+def _gemini_generate(content, prompt, model, temperature, top_p, max_tokens, stream, timeout=None):
+    genai = sdk.load("Gemini")
+    gemini_model = genai.GenerativeModel(model_name=model)
+    full_prompt = _full_prompt(content, prompt)
+    return gemini_model.generate_content(
+        full_prompt,
+        generation_config=genai.types.GenerationConfig(
+            temperature=temperature,
+            top_p=top_p,
+            max_output_tokens=max_tokens,
+        ),
+        request_options={"timeout": timeout} if timeout else None,
+        stream=stream
+    )
+
 def process_text_openai(content, prompt, model, temperature, max_tokens):
     try:
         logger.info(f"Starting text processing with OpenAI. Model: {model}, Temperature: {temperature}, Max Tokens: {max_tokens}")
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            logger.error("OPENAI_API_KEY environment variable is not set")
-            raise ValueError("OPENAI_API_KEY environment variable is not set")
-
-        client = OpenAI(api_key=api_key)
-        full_prompt = f"{content}\n\n{prompt}"
-        
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": full_prompt}
-            ],
-            temperature=temperature,
-            max_tokens=max_tokens
-        )
-        
+        with metrics.stage("generate"):
+            completion = call_with_retry(
+                "OpenAI", model,
+                lambda timeout: _openai_completion(content, prompt, model, temperature, max_tokens, stream=False, timeout=timeout),
+                estimate_tokens(content, prompt, max_tokens=max_tokens)
+            )
+        metrics.record_usage(getattr(completion, "usage", None))
         logger.info("Content generated successfully by OpenAI model")
         return completion.choices[0].message.content if completion.choices else None
     except Exception as e:
         logger.error(f"An error occurred while processing the text with OpenAI: {str(e)}")
         return None
 
+def stream_text_openai(content, prompt, model, temperature, max_tokens):
+    try:
+        logger.info(f"Starting streamed text processing with OpenAI. Model: {model}, Temperature: {temperature}, Max Tokens: {max_tokens}")
+        def generate(timeout):
+            for chunk in _openai_completion(content, prompt, model, temperature, max_tokens, stream=True, timeout=timeout):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                metrics.record_usage(chunk.usage)
+
+        with metrics.stage("generate"):
+            yield from stream_with_retry("OpenAI", model, generate, estimate_tokens(content, prompt, max_tokens=max_tokens))
+        logger.info("Content streamed successfully by OpenAI model")
+    except StreamInterrupted as e:
+        logger.error(f"Stream interrupted, discarding the partial response: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred while streaming the text from OpenAI: {str(e)}")
+
+def _openai_completion(content, prompt, model, temperature, max_tokens, stream, timeout=None):
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        logger.error("OPENAI_API_KEY environment variable is not set")
+        raise ValueError("OPENAI_API_KEY environment variable is not set")
+
+    client = get_openai_client(api_key)
+    full_prompt = _full_prompt(content, prompt)
+    return client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": full_prompt}
+        ],
+        temperature=temperature,
+        max_tokens=max_tokens,
+        stream=stream,
+        timeout=timeout,
+        **({"stream_options": {"include_usage": True}} if stream else {})
+    )
+
 def process_text_claude(content, prompt, model, max_tokens):
     try:
         logger.info(f"Starting text processing with Claude. Model: {model}, Max Tokens: {max_tokens}")
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            logger.error("ANTHROPIC_API_KEY environment variable is not set")
-            raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
-
-        client = anthropic.Anthropic(api_key=api_key)
-        full_prompt = f"{content}\n\n{prompt}"
-
-        message = client.messages.create(
-            model=model,
-            max_tokens=max_tokens,
-            messages=[
-                {
-                    "role": "user",
-                    "content": full_prompt
-                }
-            ]
-        )
-
+        client = _claude_client()
+        request = _claude_request(content, prompt, model, max_tokens)
+        with metrics.stage("generate"):
+            message = call_with_retry(
+                "Claude", model, lambda timeout: client.messages.create(**request, timeout=timeout), estimate_tokens(content, prompt, max_tokens=max_tokens)
+            )
+        metrics.record_usage(getattr(message, "usage", None))
         logger.info("Content generated successfully by Claude model")
         return message.content[0].text if message.content else None
     except Exception as e:
         logger.error(f"An error occurred while processing the text with Claude: {str(e)}")
         return None
+
+def stream_text_claude(content, prompt, model, max_tokens):
+    try:
+        logger.info(f"Starting streamed text processing with Claude. Model: {model}, Max Tokens: {max_tokens}")
+        client = _claude_client()
+        request = _claude_request(content, prompt, model, max_tokens)
+
+        def generate(timeout):
+            with client.messages.stream(**request, timeout=timeout) as stream:
+                yield from stream.text_stream
+                metrics.record_usage(stream.get_final_message().usage)
+
+        with metrics.stage("generate"):
+            yield from stream_with_retry("Claude", model, generate, estimate_tokens(content, prompt, max_tokens=max_tokens))
+        logger.info("Content streamed successfully by Claude model")
+    except StreamInterrupted as e:
+        logger.error(f"Stream interrupted, discarding the partial response: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred while streaming the text from Claude: {str(e)}")
+
+def _claude_client():
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        logger.error("ANTHROPIC_API_KEY environment variable is not set")
+        raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
+    return get_anthropic_client(api_key)
+
+def _claude_request(content, prompt, model, max_tokens):
+    full_prompt = _full_prompt(content, prompt)
+    return {
+        "model": model,
+        "max_tokens": max_tokens,
+        "messages": [
+            {
+                "role": "user",
+                "content": full_prompt
+            }
+        ],
+    }
@@ -0,0 +1,61 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from PIL import Image, ImageOps
+from utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "80"))
+# Thumbnails are shared by every session in the process, keyed by the image's content hash.
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv("THUMBNAIL_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_lock = threading.Lock()
+
+
+def _cached(digest):
+    with _lock:
+        thumbnail = _cache.get(digest)
+        if thumbnail is not None:
+            _cache.move_to_end(digest)
+        return thumbnail
+
+
+def _store(digest, thumbnail):
+    global _cache_bytes
+    with _lock:
+        if digest in _cache:
+            return
+        _cache[digest] = thumbnail
+        _cache_bytes += len(thumbnail)
+        while _cache_bytes > THUMBNAIL_CACHE_MAX_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
+
+
+def thumbnail(data, size=THUMBNAIL_SIZE):
+    """Return a JPEG of the image no larger than size x size, generated once per distinct image."""
+    digest = hashlib.sha256(data).hexdigest()
+    cached = _cached(digest)
+    if cached is not None:
+        return cached
+    try:
+        with Image.open(BytesIO(data)) as img:
+            # Lets the JPEG decoder skip most of the full-resolution work.
+            img.draft("RGB", (size, size))
+            img = ImageOps.exif_transpose(img)
+            if img.mode != "RGB":
+                img = img.convert("RGB")
+            img.thumbnail((size, size), Image.LANCZOS)
+            output = BytesIO()
+            img.save(output, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning(f"Could not generate a thumbnail, using the original image: {str(e)}")
+        return data
+    _store(digest, output.getvalue())
+    return output.getvalue()
@@ -0,0 +1,54 @@
+from functools import lru_cache
+
+# Providers with a published local tokenizer use it; the others are estimated from their
+# documented average characters per token.
+PROVIDER_ENCODINGS = {"OpenAI": "o200k_base"}
+CHARS_PER_TOKEN = {"Gemini": 4.0, "Claude": 3.5, "Meta-Llama": 4.0}
+PROVIDERS = ("Gemini", "OpenAI", "Claude", "Meta-Llama")
+
+
+@lru_cache(maxsize=None)
+def _encoding(name):
+    import tiktoken
+    return tiktoken.get_encoding(name)
+
+
+def count_tokens(text, tokenizer="OpenAI"):
+    # tokenizer is a provider name or a tiktoken encoding name such as "cl100k_base".
+    if not text:
+        return 0
+    if tokenizer in CHARS_PER_TOKEN:
+        return max(1, round(len(text) / CHARS_PER_TOKEN[tokenizer]))
+    return len(_encoding(PROVIDER_ENCODINGS.get(tokenizer, tokenizer)).encode(text, disallowed_special=()))
+
+
+class TokenTally:
+    """Running token count over a chat's messages; each message is tokenized once per tokenizer."""
+
+    def __init__(self):
+        self.counts = []
+        self.totals = {}
+
+    def update(self, messages):
+        # Messages are only ever appended or cleared, so checking the last counted one catches a reset.
+        if len(messages) < len(self.counts) or (
+            self.counts and self.counts[-1]["content_hash"] != hash(messages[len(self.counts) - 1]["content"])
+        ):
+            self.counts = []
+            self.totals = {}
+        for message in messages[len(self.counts):]:
+            entry = {"content": message["content"], "content_hash": hash(message["content"]), "tokens": {}}
+            self.counts.append(entry)
+        return self
+
+    def total(self, tokenizer="OpenAI"):
+        counted, total = self.totals.get(tokenizer, (0, 0))
+        for entry in self.counts[counted:]:
+            entry["tokens"][tokenizer] = count_tokens(entry["content"], tokenizer)
+            total += entry["tokens"][tokenizer]
+        self.totals[tokenizer] = (len(self.counts), total)
+        return total
+
+    def message_tokens(self, index, tokenizer="OpenAI"):
+        self.total(tokenizer)
+        return self.counts[index]["tokens"][tokenizer]
@@ -1,18 +1,19 @@
 import streamlit as st
-import google.generativeai as genai
 from dotenv import load_dotenv
 import os
 import time
-from PyPDF2 import PdfReader
-from io import BytesIO
 import json
-import tiktoken
 from streamlit_float import *
 from datetime import datetime
 
-# Load environment variables
+# Load environment variables before importing utils: its modules read their settings at import time.
 load_dotenv()
 
+from utils.chat import ChatConversation
+from utils.pdf_processing import cached_text, extract_pdf_text
+from utils.retrieval import build_context
+from utils.tokens import PROVIDERS, TokenTally
+
 def page_setup():
     st.header("Chat with a Gemini!", anchor=False, divider="blue")
     hide_menu_style = """
@@ -30,104 +31,58 @@ def get_llminfo():
     maxtokens = st.sidebar.slider("Maximum Tokens:", min_value=100, max_value=8194, value=2000, step=100)
     return model, temp, topp, maxtokens
 
-def process_text(user_input, gemini_model, temperature, top_p, max_tokens):
-    try:
-        response = gemini_model.generate_content(
-            user_input,
-            generation_config={
-                "temperature": temperature,
-                "top_p": top_p,
-                "max_output_tokens": max_tokens,
-            }
-        )
-        return response
-    except Exception as e:
-        st.error(f"An error occurred while processing text: {str(e)}")
-        return None
-
-def process_image(image_file, prompt, gemini_model, temperature, top_p, max_tokens):
-    try:
-        with open(image_file.name, "wb") as f:
-            f.write(image_file.getbuffer())
-        uploaded_image = genai.upload_file(path=image_file.name)
-        while uploaded_image.state.name == "PROCESSING":
-            time.sleep(2)
-            uploaded_image = genai.get_file(uploaded_image.name)
-        if uploaded_image.state.name == "FAILED":
-            raise ValueError("Image processing failed")
-        response = gemini_model.generate_content(
-            [uploaded_image, prompt],
-            generation_config={
-                "temperature": temperature,
-                "top_p": top_p,
-                "max_output_tokens": max_tokens,
-            },
-            request_options={"timeout": 120}
-        )
-        os.remove(image_file.name)
-        genai.delete_file(uploaded_image.name)
-        return response
-    except Exception as e:
-        st.error(f"An error occurred while processing the image: {str(e)}")
-        if os.path.exists(image_file.name):
-            os.remove(image_file.name)
-        return None
-
 def process_pdf(pdf_file):
     try:
-        pdf_reader = PdfReader(BytesIO(pdf_file.read()))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text()
+        data = pdf_file.getvalue()
+        # Cached by content hash, so reruns and other sessions with the same PDF skip extraction.
+        text = cached_text(data)
+        if text is None:
+            progress = st.progress(0.0, text="Extracting PDF text...")
+            text = extract_pdf_text(
+                data, lambda done, total: progress.progress(done / total, text=f"Extracting page {done} of {total}...")
+            )
+            progress.empty()
         return text
     except Exception as e:
         st.error(f"An error occurred while processing the PDF: {str(e)}")
         return None
     
-def process_image_with_context(image_file, prompt, conversation_history, gemini_model, temperature, top_p, max_tokens):
-    try:
-        image_data = image_file.getvalue()
-        
-        # Construct a context-aware prompt
-        context_prompt = "Previous conversation:\n"
-        for message in conversation_history:
-            context_prompt += f"{message['role'].capitalize()}: {message['content']}\n"
-        context_prompt += f"\nNew image uploaded. {prompt}"
-        
-        response = gemini_model.generate_content(
-            [image_data, context_prompt],
-            generation_config={
-                "temperature": temperature,
-                "top_p": top_p,
-                "max_output_tokens": max_tokens,
-            },
-            request_options={"timeout": 120}
-        )
-        return response
-    except Exception as e:
-        st.error(f"An error occurred while processing the image: {str(e)}")
-        return None   
-
-def process_text_with_image_context(user_input, image_data, conversation_history, gemini_model, temperature, top_p, max_tokens):
-    try:
-        context_prompt = "Previous conversation:\n"
-        for message in conversation_history:
-            context_prompt += f"{message['role'].capitalize()}: {message['content']}\n"
-        context_prompt += f"\nUser: {user_input}"
-        
-        response = gemini_model.generate_content(
-            [image_data, context_prompt],
-            generation_config={
-                "temperature": temperature,
-                "top_p": top_p,
-                "max_output_tokens": max_tokens,
-            },
-            request_options={"timeout": 120}
-        )
-        return response
-    except Exception as e:
-        st.error(f"An error occurred while processing the query: {str(e)}")
+def pdf_context_for(query):
+    # Only the chunks of the PDF most relevant to the query are sent, not the whole document.
+    context, hits = build_context(st.session_state.pdf_content, query)
+    st.session_state.retrieved_chunks = hits
+    st.session_state.pdf_sent_whole = None
+    return context
+
+def pdf_turn_context(query):
+    conversation = st.session_state.conversation
+    if conversation.pins_document():
+        # The whole PDF is pinned at the start of the chat, a stable prefix the provider can cache between turns.
+        st.session_state.retrieved_chunks = None
+        st.session_state.pdf_sent_whole = "cached" if conversation.caches_document() else "pinned"
         return None
+    return pdf_context_for(query)
+
+def show_retrieved_chunks():
+    sent_whole = st.session_state.get("pdf_sent_whole")
+    if sent_whole and st.session_state.pdf_content:
+        where = "where the provider caches it" if sent_whole == "cached" else "ahead of the conversation"
+        st.caption(f"🔎 The whole PDF ({len(st.session_state.pdf_content):,} characters) is pinned at the start of the chat, {where}, not retrieved chunks.")
+        return
+    hits = st.session_state.get("retrieved_chunks")
+    if not hits:
+        return
+    with st.expander(f"🔎 PDF chunks sent with the last query ({len(hits)})"):
+        for index, score, chunk in hits:
+            st.markdown(f"**Chunk {index}** · score {score:.2f}")
+            st.text(chunk)
+
+def send_chat(text, temperature, top_p, max_tokens, context=None):
+    # The conversation keeps the native multi-turn history, so only the new turn is passed in.
+    response = st.session_state.conversation.send(text, temperature, top_p, max_tokens, context=context)
+    if response is None:
+        st.warning("Content generation was blocked or no valid content was generated.")
+    return response
 
 @st.dialog("🎨 Upload a picture")
 def upload_document():
@@ -167,9 +122,6 @@ def main():
     if GEMINI_API_KEY is None:
         st.error("GEMINI_API_KEY environment variable is not set")
         return
-    genai.configure(api_key=GEMINI_API_KEY)
-
-    gemini_model = genai.GenerativeModel(model_name=model)
 
     if "messages" not in st.session_state:
         st.session_state.messages = []
@@ -177,6 +129,11 @@ def main():
         st.session_state.pdf_content = None
     if "chat_started" not in st.session_state:
         st.session_state.chat_started = False
+    if "token_tally" not in st.session_state:
+        st.session_state.token_tally = TokenTally()
+    if "conversation" not in st.session_state:
+        st.session_state.conversation = ChatConversation("Gemini", model)
+    st.session_state.conversation.set_model("Gemini", model)
 
     input_type = st.radio("Choose input type:", ("Text", "Image", "PDF"))
 
@@ -184,15 +141,13 @@ def main():
         user_input = st.text_area("Enter your text here:", height=150)
         if st.button("Submit Text"):
             if user_input:
-                response = process_text(user_input, gemini_model, temperature, top_p, max_tokens)
-                if response and response.parts:
+                response = send_chat(user_input, temperature, top_p, max_tokens)
+                if response:
                     st.markdown("### Response:")
-                    st.markdown(response.text)
+                    st.markdown(response)
                     st.session_state.messages.append({"role": "user", "content": user_input})
-                    st.session_state.messages.append({"role": "assistant", "content": response.text})
+                    st.session_state.messages.append({"role": "assistant", "content": response})
                     st.session_state.chat_started = True
-                elif response:
-                    st.warning("Content generation was blocked or no valid content was generated.")
             else:
                 st.warning("Please enter some text before submitting.")
 
@@ -201,15 +156,14 @@ def main():
         prompt = st.text_input("Enter a prompt for the image:")
         if st.button("Process Image"):
             if uploaded_file is not None and prompt:
-                response = process_image(uploaded_file, prompt, gemini_model, temperature, top_p, max_tokens)
-                if response and response.parts:
+                st.session_state.conversation.attach_image(uploaded_file.getvalue(), uploaded_file.type, uploaded_file.name)
+                response = send_chat(prompt, temperature, top_p, max_tokens)
+                if response:
                     st.markdown("### Response:")
-                    st.markdown(response.text)
+                    st.markdown(response)
                     st.session_state.messages.append({"role": "user", "content": f"[Image uploaded] {prompt}"})
-                    st.session_state.messages.append({"role": "assistant", "content": response.text})
+                    st.session_state.messages.append({"role": "assistant", "content": response})
                     st.session_state.chat_started = True
-                elif response:
-                    st.warning("Content generation was blocked or no valid content was generated.")
             else:
                 st.warning("Please upload an image and enter a prompt before processing.")
 
@@ -220,19 +174,18 @@ def main():
             if pdf_content:
                 st.success("PDF processed successfully!")
                 st.session_state.pdf_content = pdf_content
+                st.session_state.conversation.attach_document(pdf_content)
                 query = st.text_area("Enter your query about the PDF:")
                 if st.button("Submit Query"):
                     if query:
-                        full_prompt = f"{pdf_content}\n\nUser: {query}"
-                        response = process_text(full_prompt, gemini_model, temperature, top_p, max_tokens)
-                        if response and response.parts:
+                        response = send_chat(query, temperature, top_p, max_tokens, context=pdf_turn_context(query))
+                        if response:
                             st.markdown("### Initial Response:")
-                            st.markdown(response.text)
+                            st.markdown(response)
+                            show_retrieved_chunks()
                             st.session_state.messages.append({"role": "user", "content": query})
-                            st.session_state.messages.append({"role": "assistant", "content": response.text})
+                            st.session_state.messages.append({"role": "assistant", "content": response})
                             st.session_state.chat_started = True
-                        else:
-                            st.warning("No valid response generated.")
                     else:
                         st.warning("Please enter a query before submitting.")
             else:
@@ -252,29 +205,14 @@ def main():
             with st.chat_message("user"):
                 st.markdown(user_input)
 
-            if "current_image" in st.session_state and st.session_state.current_image is not None:
-                # Process with image context
-                response = process_text_with_image_context(
-                    user_input,
-                    st.session_state.current_image,
-                    st.session_state.messages,
-                    gemini_model,
-                    temperature,
-                    top_p,
-                    max_tokens
-                )
-            else:
-                # Process without image context
-                full_prompt = f"{st.session_state.pdf_content}\n\n" if st.session_state.pdf_content else ""
-                full_prompt += "\n".join([f"{m['role'].capitalize()}: {m['content']}" for m in st.session_state.messages])
-                response = process_text(full_prompt, gemini_model, temperature, top_p, max_tokens)
-
-            if response and response.parts:
-                st.session_state.messages.append({"role": "assistant", "content": response.text})
+            # The PDF, if any, contributes its chunks relevant to this question only.
+            context = pdf_turn_context(user_input) if st.session_state.pdf_content else None
+            response = send_chat(user_input, temperature, top_p, max_tokens, context=context)
+            if response:
+                st.session_state.messages.append({"role": "assistant", "content": response})
                 with st.chat_message("assistant"):
-                    st.markdown(response.text)
-            else:
-                st.warning("No valid response generated.")
+                    st.markdown(response)
+                show_retrieved_chunks()
 
         
   # Action buttons
@@ -300,15 +238,19 @@ def main():
             )
 
         with col2:
-            enc = tiktoken.get_encoding("cl100k_base")
-            tokenized_full_text = enc.encode(" ".join([item["content"] for item in st.session_state.messages]))
-            label = f"💬 {len(tokenized_full_text)} tokens"
-            st.link_button(label, "https://platform.openai.com/tokenizer")
+            # Only messages added since the last rerun are tokenized.
+            tally = st.session_state.token_tally.update(st.session_state.messages)
+            label = f"💬 {tally.total('cl100k_base')} tokens"
+            per_provider = ", ".join(f"{provider}: {tally.total(provider)}" for provider in PROVIDERS)
+            st.link_button(label, "https://platform.openai.com/tokenizer", help=per_provider)
 
         with col3:
             if st.button("🧹 Clear Chat"):
                 st.session_state.messages = []
                 st.session_state.pdf_content = None
+                st.session_state.retrieved_chunks = None
+                st.session_state.pdf_sent_whole = None
+                st.session_state.conversation = ChatConversation("Gemini", model)
                 st.session_state.chat_started = False
                 st.rerun()
 
@@ -322,22 +264,15 @@ def main():
         prompt = st.text_input("Enter a prompt for the image:", key="image_prompt")
         if st.button("Process Image"):
             if prompt:
-                image_response = process_image_with_context(
-                    uploaded_file, 
-                    prompt,
-                    st.session_state.messages,
-                    gemini_model, 
-                    temperature, 
-                    top_p, 
-                    max_tokens
-                )
-                if image_response and image_response.parts:
+                # The image is pinned at the head of the conversation, so follow-ups can refer to it.
+                st.session_state.conversation.attach_image(uploaded_file.getvalue(), uploaded_file.type, uploaded_file.name)
+                image_response = send_chat(prompt, temperature, top_p, max_tokens)
+                if image_response:
                     st.session_state.messages.append({"role": "user", "content": f"[Image uploaded] {prompt}"})
-                    st.session_state.messages.append({"role": "assistant", "content": image_response.text})
+                    st.session_state.messages.append({"role": "assistant", "content": image_response})
                     with st.chat_message("assistant"):
-                        st.markdown(image_response.text)
+                        st.markdown(image_response)
                     st.success("Image processed and added to the conversation.")
-                    st.session_state.current_image = uploaded_file.getvalue()  # Store the image data
                     del st.session_state["uploaded_pic"]
                     st.rerun()
                 else: